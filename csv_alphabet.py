@@ -6,9 +6,14 @@ import pathlib
 import argparse
 import csv
 import locale
+import hashlib
+import math
 
 locale.setlocale(locale.LC_ALL, '')
 
+min_hll_precision = 4
+max_hll_precision = 18
+
 class ColumnMode(str):
 	pass
 MODE_ANY = ColumnMode('any')
@@ -18,6 +23,77 @@ def get_from_indexes(orig_row, indexes):
 	permuted_row = [ orig_row[i] for i in indexes ]
 	return permuted_row
 
+# Copied from csv_histo
+class HyperLogLog:
+	"""Estimator of the number of distinct items in a stream (the HyperLogLog algorithm of Flajolet et al.), using 2**precision one-byte registers. The standard error of the estimate is about 1.04/sqrt(2**precision).
+
+	Two estimators with the same precision can be merged (see update), and the registers can be saved to and loaded from a file."""
+	file_magic = b'HLL1'
+
+	def __init__(self, precision: int=14):
+		if not min_hll_precision <= precision <= max_hll_precision:
+			raise ValueError('HyperLogLog precision must be from {} to {}'.format(min_hll_precision, max_hll_precision))
+		self.precision = precision
+		self.registers = bytearray(1 << precision)
+
+	def add(self, item):
+		hash_value = int.from_bytes(hashlib.blake2b(repr(item).encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+		remaining_bits = 64 - self.precision
+		index = hash_value >> remaining_bits
+		# The position of the first 1 bit in the rest of the hash.
+		rank = remaining_bits - (hash_value & ((1 << remaining_bits) - 1)).bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def update(self, other):
+		"Merge another estimator into this one, as if this one had also seen everything the other one did."
+		if other.precision != self.precision:
+			raise ValueError('Cannot merge HyperLogLog registers with precision {} into registers with precision {}'.format(other.precision, self.precision))
+		self.registers = bytearray(map(max, self.registers, other.registers))
+
+	def estimate(self):
+		num_registers = len(self.registers)
+		alpha = { 16: 0.673, 32: 0.697, 64: 0.709 }.get(num_registers, 0.7213 / (1 + 1.079 / num_registers))
+		raw_estimate = alpha * num_registers * num_registers / math.fsum(2.0 ** -rank for rank in self.registers)
+		num_zeros = self.registers.count(0)
+		if raw_estimate <= 2.5 * num_registers and num_zeros:
+			# Few items: count empty registers instead (linear counting).
+			return num_registers * math.log(num_registers / num_zeros)
+		return raw_estimate
+
+	def standard_error(self):
+		return 1.04 / math.sqrt(len(self.registers))
+
+	def save(self, path: pathlib.Path):
+		with open(path, 'wb') as f:
+			f.write(self.file_magic + bytes([ self.precision ]) + self.registers)
+
+	@classmethod
+	def load(cls, path: pathlib.Path):
+		with open(path, 'rb') as f:
+			data = f.read()
+		if data[:len(cls.file_magic)] != cls.file_magic:
+			raise ValueError('{} is not a HyperLogLog registers file'.format(path))
+		precision = data[len(cls.file_magic)]
+		self = cls(precision)
+		registers = data[len(cls.file_magic) + 1:]
+		if len(registers) != len(self.registers):
+			raise ValueError('{} is truncated'.format(path))
+		self.registers = bytearray(registers)
+		return self
+
+# Copied from csv_histo
+def merged_registers(hll: HyperLogLog, opts: argparse.Namespace):
+	"Merge the registers files named by --load-registers into hll, and save the result if --save-registers was given."
+	for path in opts.load_registers:
+		try:
+			hll.update(HyperLogLog.load(path))
+		except ValueError as exc:
+			sys.exit('{}: {}'.format(path, exc))
+	if opts.save_registers:
+		hll.save(opts.save_registers)
+	return hll
+
 def select_distinct(input_path: pathlib.Path, columns_of_interest: list, mode: ColumnMode):
 	found_values = set()
 
@@ -46,22 +122,67 @@ def select_distinct(input_path: pathlib.Path, columns_of_interest: list, mode: C
 
 	return found_values
 
+def estimate_distinct(input_path: pathlib.Path, columns_of_interest: list, mode: ColumnMode, precision: int):
+	"Like select_distinct, but only estimate the number of distinct values, using a HyperLogLog estimator."
+	hll = HyperLogLog(precision)
+
+	with open(input_path, 'r') as input_file:
+		reader = csv.reader(input_file)
+		header = next(reader)
+
+		indexes = []
+		for col in columns_of_interest:
+			try:
+				idx = header.index(col)
+			except ValueError:
+				pass
+			else:
+				indexes.append(idx)
+
+		if mode == MODE_ALL:
+			for orig_row in reader:
+				permuted_row = get_from_indexes(orig_row, indexes)
+				hll.add(tuple(permuted_row))
+		elif mode == MODE_ANY:
+			for orig_row in reader:
+				permuted_row = get_from_indexes(orig_row, indexes)
+				for value in permuted_row:
+					hll.add((value,))
+
+	return hll
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--all', action='store_const', const=MODE_ALL, dest='mode', default=MODE_ALL, help='Return combinations of all columns. This is the default.')
 	parser.add_argument('--any', action='store_const', const=MODE_ANY, dest='mode', default=MODE_ALL, help='Return all values from any column—that is, the union of all columns.')
 	parser.add_argument('--column', action='append', dest='column_names', help="Column to collect distinct values from.")
-	parser.add_argument('input_paths', type=pathlib.Path, nargs='+', help="Paths to files containing CSV data to inventory.")
+	parser.add_argument('--estimate-distinct', action='store_true', default=False, help="Don't list the distinct values; only estimate how many there are, using a HyperLogLog estimator of fixed size (see --hll-precision). Each input file's registers are merged into one estimate, which is printed on stderr.")
+	parser.add_argument('--hll-precision', metavar='BITS', default=14, type=int, help="With --estimate-distinct, use 2**BITS registers of one byte each (from {} to {}). More registers give a smaller standard error, about 1.04/sqrt(2**BITS): the default of 14 uses 16 KiB for about 0.8%%.".format(min_hll_precision, max_hll_precision))
+	parser.add_argument('--save-registers', metavar='PATH', default=None, type=pathlib.Path, help="With --estimate-distinct, save the HyperLogLog registers to this file, to merge with others later using --load-registers.")
+	parser.add_argument('--load-registers', metavar='PATH', action='append', default=[], type=pathlib.Path, help="With --estimate-distinct, merge HyperLogLog registers saved by an earlier run (of csv_histo or csv_alphabet, with the same --hll-precision and columns) into the estimate. Can be used more than once.")
+	parser.add_argument('input_paths', type=pathlib.Path, nargs='*', help="Paths to files containing CSV data to inventory.")
 	opts = parser.parse_args()
+	if not (opts.input_paths or (opts.estimate_distinct and opts.load_registers)):
+		parser.error('at least one input path is required')
+	if not min_hll_precision <= opts.hll_precision <= max_hll_precision:
+		parser.error('--hll-precision must be from {} to {}'.format(min_hll_precision, max_hll_precision))
+
+	if opts.estimate_distinct:
+		all_registers = HyperLogLog(opts.hll_precision)
+		for input_path in opts.input_paths:
+			all_registers.update(estimate_distinct(input_path, opts.column_names, opts.mode, opts.hll_precision))
+		merged_registers(all_registers, opts)
+		print('{}\t{:n}'.format('estimated total', round(all_registers.estimate())), file=sys.stderr)
+		print('{}\t{:.2%}'.format('standard error', all_registers.standard_error()), file=sys.stderr)
+	else:
+		all_combos = set()
+		num_combos = 0
+		for input_path in opts.input_paths:
+			these_combos = select_distinct(input_path, opts.column_names, opts.mode)
+			all_combos |= these_combos
 
-	all_combos = set()
-	num_combos = 0
-	for input_path in opts.input_paths:
-		these_combos = select_distinct(input_path, opts.column_names, opts.mode)
-		all_combos |= these_combos
-
-	writer = csv.writer(sys.stdout)
-	for combination in sorted(all_combos):
-		writer.writerow(combination)
-		num_combos += 1
-	print('{}\t{:n}'.format('total', num_combos), file=sys.stderr)
+		writer = csv.writer(sys.stdout)
+		for combination in sorted(all_combos):
+			writer.writerow(combination)
+			num_combos += 1
+		print('{}\t{:n}'.format('total', num_combos), file=sys.stderr)
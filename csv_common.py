@@ -5,40 +5,586 @@ import sys
 import pathlib
 import argparse
 import csv
+import array
+import bisect
+import hashlib
+import heapq
+import io
+import itertools
+import math
+import mmap
+import multiprocessing
+import operator
+import shutil
+import struct
+import tempfile
 
-def find_common(needle_path: pathlib.Path, needle_column: str, haystack_path: pathlib.Path, haystack_column: str):
-	needles = set()
+# Copied from csv_select
+def parse_byte_count(count_str: str):
+	"Parse a number of bytes, optionally followed by K, M, G, or T (powers of 1024)."
+	multipliers = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+	count_str = count_str.strip().upper().rstrip('B')
+	multiplier = 1
+	if count_str and count_str[-1] in multipliers:
+		multiplier = multipliers[count_str[-1]]
+		count_str = count_str[:-1]
+	return int(float(count_str) * multiplier)
+
+# Approximate memory cost of one needle in a set, not counting the characters of the value itself.
+bytes_per_needle = 90
+
+def estimated_size(value):
+	"Approximate memory cost of one needle (a string, or a tuple of strings) in a set, or of a row of values (a list or tuple of strings and numbers) in a list."
+	if isinstance(value, str):
+		return len(value) + bytes_per_needle
+	if isinstance(value, int):
+		return bytes_per_needle
+	return sum(map(estimated_size, value)) + bytes_per_needle
+
+def value_digest(value):
+	"Return the digest of a key, which is either a string or (for a composite key) a tuple of strings."
+	if isinstance(value, tuple):
+		value = repr(value)
+	return hashlib.blake2b(value.encode('utf-8', 'surrogatepass'), digest_size=NeedleDigestFile.digest_size).digest()
+
+class DigestArray:
+	"A sorted array of fixed-width digests within a memory-mapped file, which can be searched with bisect."
+	def __init__(self, mapped: mmap.mmap, offset: int, count: int, digest_size: int):
+		self.mapped = mapped
+		self.offset = offset
+		self.count = count
+		self.digest_size = digest_size
+	def __len__(self):
+		return self.count
+	def __getitem__(self, i):
+		start = self.offset + i * self.digest_size
+		return self.mapped[start:start + self.digest_size]
+
+class NeedleDigestFile:
+	"""A set of needle values kept on disk, for when there are too many to hold in memory.
+
+	Each value is stored as a digest. The file starts with a magic number, the number of digests, the size of the Bloom filter in bits, and the number of hashes the filter uses. Then comes a table with the position of the first digest starting with each possible pair of bytes (plus the total, at the end), the Bloom filter's bits, and finally the digests themselves, sorted. Looking up a value checks the Bloom filter first, which rules out most values that aren't needles without touching the digests; any others are looked up by binary search within the range the table gives for the digest's first two bytes."""
+	magic = b'csvcmnix'
+	digest_size = 16
+	header_format = '<8sQQQ'
+	num_prefixes = 1 << 16
+	num_partitions = 256
+	# Approximate memory cost of one digest while a partition is being sorted: the bytes object, its slot in a set, and its slot in the sorted list.
+	bytes_per_sorted_digest = 120
+	# Number of digests read at a time when splitting a partition.
+	digests_per_read = 1 << 16
+	# The least memory that sorting a partition is allowed, however small the memory budget.
+	min_sort_budget = 1 << 20
+
+	@classmethod
+	def layout(cls, bloom_bits: int):
+		"Return the offsets of the prefix table, Bloom filter, and digests in a file with a Bloom filter of the given size."
+		prefix_table_offset = struct.calcsize(cls.header_format)
+		bloom_offset = prefix_table_offset + 8 * (cls.num_prefixes + 1)
+		digests_offset = bloom_offset + bloom_bits // 8
+		return prefix_table_offset, bloom_offset, digests_offset
+
+	@classmethod
+	def build(cls, path: pathlib.Path, values, memory_budget: int, temp_dir: str):
+		"""Write a digest file of values (an iterable of strings) to path. Up to half the memory budget goes to the Bloom filter; the rest bounds the memory used to sort the digests.
+
+		The digests are first written to temporary files partitioned by their first byte. Then each partition is sorted and appended to the digest file in turn, so the whole file ends up in sorted order. A partition too big to sort within the budget is split further by the next byte (see sorted_partitions)."""
+		partition_paths = [ os.path.join(temp_dir, 'needles-{:03d}.bin'.format(i)) for i in range(cls.num_partitions) ]
+		partition_files = [ open(partition_path, 'wb') for partition_path in partition_paths ]
+		num_digests = 0
+		for value in values:
+			digest = value_digest(value)
+			partition_files[digest[0]].write(digest)
+			num_digests += 1
+		for f in partition_files:
+			f.close()
+
+		# Size the filter in whole 64-bit words, and no bigger than needed for a false positive rate of about 0.05%.
+		bloom_bits = max(64, min((memory_budget // 2) * 8, 16 * num_digests) // 64 * 64)
+		num_hashes = min(16, max(1, round(bloom_bits / max(num_digests, 1) * math.log(2))))
+		bloom = BloomFilter(bytearray(bloom_bits // 8), num_hashes)
+		sort_budget = max(cls.min_sort_budget, memory_budget - bloom_bits // 8)
+		# The number of digests starting with each pair of bytes, made into the position of the first of them afterward.
+		prefix_table = array.array('Q', [ 0 ]) * (cls.num_prefixes + 1)
+
+		prefix_table_offset, bloom_offset, digests_offset = cls.layout(bloom_bits)
+		count = 0
+		with open(path, 'wb') as f:
+			f.seek(digests_offset)
+			for partition_path in partition_paths:
+				for digests in cls.sorted_partitions(partition_path, 1, sort_budget):
+					for digest in digests:
+						bloom.add(digest)
+						prefix_table[digest[0] << 8 | digest[1]] += 1
+					f.write(b''.join(digests))
+					count += len(digests)
+			position = 0
+			for prefix in range(cls.num_prefixes + 1):
+				prefix_table[prefix], position = position, position + prefix_table[prefix]
+
+			f.seek(0)
+			f.write(struct.pack(cls.header_format, cls.magic, count, bloom_bits, num_hashes))
+			f.write(prefix_table.tobytes())
+			f.write(bloom.bits)
+
+		return cls(path)
+
+	@classmethod
+	def sorted_partitions(cls, partition_path: str, depth: int, sort_budget: int):
+		"""Yield the unique digests in the partition file at partition_path, whose digests all start with the same depth bytes, as sorted lists, in order. The file is removed afterward.
+
+		If sorting the whole partition would take more than sort_budget bytes (approximately), it is first split into sub-partitions by the next byte, and each of those is sorted in turn (and split again if need be)."""
+		num_digests = os.path.getsize(partition_path) // cls.digest_size
+		if num_digests * cls.bytes_per_sorted_digest <= sort_budget or depth >= cls.digest_size - 1:
+			with open(partition_path, 'rb') as partition_file:
+				data = partition_file.read()
+			os.remove(partition_path)
+			digests = sorted(set(data[i:i + cls.digest_size] for i in range(0, len(data), cls.digest_size)))
+			del data
+			yield digests
+			return
+
+		sub_partition_paths = [ '{}-{:03d}'.format(partition_path, i) for i in range(256) ]
+		sub_partition_files = [ open(sub_partition_path, 'wb') for sub_partition_path in sub_partition_paths ]
+		with open(partition_path, 'rb') as partition_file:
+			while True:
+				data = partition_file.read(cls.digests_per_read * cls.digest_size)
+				if not data:
+					break
+				for i in range(0, len(data), cls.digest_size):
+					sub_partition_files[data[i + depth]].write(data[i:i + cls.digest_size])
+		os.remove(partition_path)
+		for f in sub_partition_files:
+			f.close()
+		for sub_partition_path in sub_partition_paths:
+			yield from cls.sorted_partitions(sub_partition_path, depth + 1, sort_budget)
+
+	def __init__(self, path: pathlib.Path):
+		self.path = path
+		with open(path, 'rb') as f:
+			self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, self.count, bloom_bits, num_hashes = struct.unpack_from(self.header_format, self.mapped)
+		if magic != self.magic:
+			raise ValueError('{} is not a needle digest file'.format(path))
+		prefix_table_offset, bloom_offset, digests_offset = self.layout(bloom_bits)
+		view = memoryview(self.mapped)
+		self.prefix_table = view[prefix_table_offset:bloom_offset].cast('Q')
+		self.bloom = BloomFilter(view[bloom_offset:digests_offset], num_hashes)
+		self.digests = DigestArray(self.mapped, digests_offset, self.count, self.digest_size)
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, value: str):
+		digest = value_digest(value)
+		if digest not in self.bloom:
+			return False
+		prefix = digest[0] << 8 | digest[1]
+		lo, hi = self.prefix_table[prefix], self.prefix_table[prefix + 1]
+		i = bisect.bisect_left(self.digests, digest, lo, hi)
+		return i < hi and self.digests[i] == digest
+
+class BloomFilter:
+	"A Bloom filter over digests, whose bits are in a bytearray (or any writable buffer, or a read-only one for lookups only). The bit positions for each digest are derived from the two halves of the digest by double hashing."
+	def __init__(self, bits, num_hashes: int):
+		self.bits = bits
+		self.num_bits = len(bits) * 8
+		self.num_hashes = num_hashes
+
+	def positions(self, digest: bytes):
+		half = len(digest) // 2
+		h1 = int.from_bytes(digest[:half], 'little')
+		h2 = int.from_bytes(digest[half:], 'little') | 1
+		num_bits = self.num_bits
+		return [ (h1 + i * h2) % num_bits for i in range(self.num_hashes) ]
+
+	def add(self, digest: bytes):
+		bits = self.bits
+		for position in self.positions(digest):
+			bits[position >> 3] |= 1 << (position & 7)
 
+	def __contains__(self, digest: bytes):
+		bits = self.bits
+		for position in self.positions(digest):
+			if not bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+def parse_key_columns(columns_str: str):
+	"Parse a comma-separated list of column names, as a row of CSV, so that a name containing a comma can be quoted. Spaces are part of the names."
+	return next(csv.reader([ columns_str ]))
+
+def key_getter(header: list, columns: list, description: str):
+	"Return a function that gets the key from a row: the value of the column, if there is one, or a tuple of the values of all the columns."
+	try:
+		indexes = [ header.index(column) for column in columns ]
+	except ValueError:
+		print('{} columns {} not found in header {}'.format(description, columns, header), file=sys.stderr)
+		raise
+	return operator.itemgetter(*indexes)
+
+def read_needle_values(needle_path: pathlib.Path, needle_columns: list):
+	"Yield the key (the value of the needle column, or a tuple of the values of the needle columns) from each row of the needle file."
 	with open(needle_path, 'r') as f:
 		reader = csv.reader(f)
 		header = next(reader)
-		try:
-			column_idx = header.index(needle_column)
-		except ValueError:
-			print('Needle column {} not found in needle file header {}'.format(needle_column, header), file=sys.stderr)
-			raise
+		get_key = key_getter(header, needle_columns, 'Needle')
 
 		for row in reader:
-			needles.add(row[column_idx])
+			yield get_key(row)
+
+def load_needles(needle_path: pathlib.Path, needle_columns: list, memory_budget: int=None, temp_dir: str=None):
+	"Return the set of keys from the needle columns. If they take up more than memory_budget bytes (approximately), they are moved into a NeedleDigestFile in temp_dir, which is returned instead."
+	needles = set()
+	needles_size = 0
+
+	values = read_needle_values(needle_path, needle_columns)
+	for value in values:
+		if value not in needles:
+			needles.add(value)
+			needles_size += estimated_size(value)
+			if memory_budget is not None and needles_size > memory_budget:
+				print('Needle values exceed memory budget; moving them to disk', file=sys.stderr)
+				values = itertools.chain(needles, values)
+				needles = None
+				return NeedleDigestFile.build(os.path.join(temp_dir, 'needles.bin'), values, memory_budget, temp_dir)
+
+	return needles
+
+# Memory budget for building a needle digest file when none is given.
+default_index_memory_budget = 256 * 1024 * 1024
+
+def needle_cache_path(cache_dir: pathlib.Path, needle_path: pathlib.Path, needle_columns: list):
+	"Return the path in cache_dir for the digest file of the needle columns. The name identifies the needle file and columns, followed by its size and modification time, so that a changed needle file gets a new digest file."
+	stat = os.stat(needle_path)
+	source_key = repr((str(needle_path.resolve()), ','.join(needle_columns))).encode('utf-8', 'surrogatepass')
+	version_key = repr((stat.st_size, stat.st_mtime_ns)).encode('utf-8')
+	return cache_dir / '{}-{}.needles'.format(hashlib.blake2b(source_key, digest_size=16).hexdigest(), hashlib.blake2b(version_key, digest_size=8).hexdigest())
+
+def open_needle_file(needle_path: pathlib.Path, needle_columns: list, memory_budget: int, cache_dir: pathlib.Path, temp_dir: str):
+	"Return a NeedleDigestFile of the needle columns. If cache_dir is given, reuse the digest file there from a previous run if the needle file hasn't changed since, or else build one there (replacing any out-of-date one). Without a cache_dir, build it in temp_dir."
+	memory_budget = memory_budget or default_index_memory_budget
+	if cache_dir is None:
+		return NeedleDigestFile.build(os.path.join(temp_dir, 'needles.bin'), read_needle_values(needle_path, needle_columns), memory_budget, temp_dir)
+
+	cache_path = needle_cache_path(cache_dir, needle_path, needle_columns)
+	if cache_path.exists():
+		return NeedleDigestFile(cache_path)
 
+	cache_dir.mkdir(parents=True, exist_ok=True)
+	for out_of_date_path in cache_dir.glob(cache_path.name.split('-')[0] + '-*.needles'):
+		out_of_date_path.unlink()
+	# Build under a temporary name in the same directory, then rename it into place (which is atomic within a file system), so that another run never sees a partial file.
+	building_fd, building_path = tempfile.mkstemp(prefix=cache_path.name + '.', suffix='.building', dir=cache_dir)
+	os.close(building_fd)
+	try:
+		NeedleDigestFile.build(building_path, read_needle_values(needle_path, needle_columns), memory_budget, temp_dir)
+		os.replace(building_path, cache_path)
+	except BaseException:
+		os.remove(building_path)
+		raise
+	print('Cached needle digests in {}'.format(cache_path), file=sys.stderr)
+	return NeedleDigestFile(cache_path)
+
+def filter_haystack(needles, haystack_path: pathlib.Path, haystack_columns: list, writer: csv.writer, previous_header: list=None):
+	"Write each row of the haystack file whose key for the haystack columns is among needles, preceded by the haystack file's header unless it's the same as previous_header. Returns the header."
 	with open(haystack_path, 'r') as f_in:
 		reader = csv.reader(f_in)
 		header = next(reader)
-		column_idx = header.index(haystack_column)
+		get_key = key_getter(header, haystack_columns, 'Haystack')
 
-		writer = csv.writer(sys.stdout)
-		writer.writerow(header)
+		if header != previous_header:
+			writer.writerow(header)
 
 		for row in reader:
-			haystack_value = row[column_idx]
-			if haystack_value in needles:
+			if get_key(row) in needles:
 				writer.writerow(row)
 
+	return header
+
+def sorted_keys(keys, path: pathlib.Path):
+	"Yield each of keys, exiting with an error if one is less than the one before it."
+	previous_key = None
+	for key in keys:
+		if previous_key is not None and key < previous_key:
+			sys.exit('{} is not sorted by the key columns: {!r} comes after {!r}'.format(path, key, previous_key))
+		yield key
+		previous_key = key
+
+def filter_haystack_sorted(needle_path: pathlib.Path, needle_columns: list, haystack_path: pathlib.Path, haystack_columns: list, writer: csv.writer, previous_header: list=None):
+	"Like filter_haystack, but by merging the needle file with the haystack file, both of which must already be sorted by their key columns. Each file is read once, and only one row of each is held in memory at a time."
+	needles = sorted_keys(read_needle_values(needle_path, needle_columns), needle_path)
+	with open(haystack_path, 'r') as f_in:
+		reader = csv.reader(f_in)
+		header = next(reader)
+		get_key = key_getter(header, haystack_columns, 'Haystack')
+
+		if header != previous_header:
+			writer.writerow(header)
+
+		needle = next(needles, None)
+		previous_key = None
+		for row in reader:
+			haystack_key = get_key(row)
+			if previous_key is not None and haystack_key < previous_key:
+				sys.exit('{} is not sorted by the key columns: {!r} comes after {!r}'.format(haystack_path, haystack_key, previous_key))
+			previous_key = haystack_key
+
+			# Skip needles that no haystack row can match anymore. Any that equal this row's key are kept for the rows that follow, which may have the same key.
+			while needle is not None and needle < haystack_key:
+				needle = next(needles, None)
+			if needle is None:
+				break
+			if needle == haystack_key:
+				writer.writerow(row)
+
+	return header
+
+join_types = [ 'inner', 'left', 'anti' ]
+
+# Number of partitions each side of a join is split into when the build side doesn't fit in the memory budget.
+num_join_partitions = 256
+
+class OverMemoryBudget(Exception):
+	pass
+
+def read_header(path: pathlib.Path):
+	with open(path, 'r') as f:
+		return next(csv.reader(f))
+
+def output_indexes(header: list, output_columns: list, key_columns: list, description: str):
+	"Return the indexes in header of the output columns. If output_columns is None, that's every column but the key columns."
+	if output_columns is None:
+		return [ i for i, name in enumerate(header) if name not in key_columns ]
+	try:
+		return [ header.index(column) for column in output_columns ]
+	except ValueError:
+		print('{} output columns {} not found in header {}'.format(description, output_columns, header), file=sys.stderr)
+		raise
+
+def read_join_rows(path: pathlib.Path, key_columns: list, output_indexes: list, description: str):
+	"Yield the key and a list of the output values from each row of a CSV file."
+	with open(path, 'r') as f:
+		reader = csv.reader(f)
+		header = next(reader)
+		get_key = key_getter(header, key_columns, description)
+
+		for row in reader:
+			yield get_key(row), [ row[i] for i in output_indexes ]
+
+# Approximate memory cost of one more reference to an object that's already in memory, such as a slot in a list (with room to sort it).
+bytes_per_reference = 16
+
+def build_join_table(rows, memory_budget: int=None):
+	"Return a dictionary mapping each key to the list of values with that key, from an iterable of (key, value) pairs, and its size in bytes (approximately, and only if there's a memory budget). Raises OverMemoryBudget if that would take more than memory_budget bytes."
+	table = {}
+	table_size = 0
+	for key, value in rows:
+		table.setdefault(key, []).append(value)
+		if memory_budget is not None:
+			table_size += estimated_size(key) + estimated_size(value)
+			if table_size > memory_budget:
+				raise OverMemoryBudget()
+	return table, table_size
+
+def joined_rows(haystack_values: list, needle_matches: list, join_type: str, empty_needle_values: list):
+	"Yield the output rows for one haystack row, given the output values of each needle row with the same key (or None if there are none)."
+	if join_type == 'anti':
+		if not needle_matches:
+			yield haystack_values
+	elif needle_matches:
+		for needle_values in needle_matches:
+			yield haystack_values + needle_values
+	elif join_type == 'left':
+		yield haystack_values + empty_needle_values
+
+def join_rows(haystack_rows, needle_rows, build_from_needles: bool, join_type: str, num_needle_outputs: int, memory_budget: int=None):
+	"""Join haystack rows (sequence number, key, output values) with needle rows (key, output values), yielding each output row with the sequence number of its haystack row, in haystack order.
+
+	The hash table is built from the needle rows if build_from_needles is true, and the haystack rows are streamed past it; otherwise, it's the other way around, and the needle values matching each haystack row are collected before the haystack rows are put back in order. Either way, everything held in memory is gathered before anything is yielded, so OverMemoryBudget (if it doesn't fit in memory_budget) is raised before any output."""
+	empty_needle_values = [ '' ] * num_needle_outputs
+	if build_from_needles:
+		table, table_size = build_join_table(needle_rows, memory_budget)
+		for sequence_number, key, haystack_values in haystack_rows:
+			for row in joined_rows(haystack_values, table.get(key), join_type, empty_needle_values):
+				yield sequence_number, row
+	else:
+		table, size = build_join_table(((key, (sequence_number, haystack_values)) for sequence_number, key, haystack_values in haystack_rows), memory_budget)
+		needle_matches = {}
+		for key, needle_values in needle_rows:
+			matching_items = table.get(key)
+			if not matching_items:
+				continue
+			for sequence_number, haystack_values in matching_items:
+				needle_matches.setdefault(sequence_number, []).append(needle_values)
+			if memory_budget is not None:
+				# The needle values are shared by every haystack row they match.
+				size += estimated_size(needle_values) + bytes_per_needle * len(matching_items)
+				if size > memory_budget:
+					raise OverMemoryBudget()
+
+		if memory_budget is not None and size + bytes_per_reference * sum(map(len, table.values())) > memory_budget:
+			raise OverMemoryBudget()
+		haystack_items = sorted(itertools.chain.from_iterable(table.values()), key=operator.itemgetter(0))
+		table = None
+		for sequence_number, haystack_values in haystack_items:
+			for row in joined_rows(haystack_values, needle_matches.get(sequence_number), join_type, empty_needle_values):
+				yield sequence_number, row
+
+def key_partition(key):
+	return value_digest(key)[0] % num_join_partitions
+
+def key_fields(key):
+	return [ key ] if isinstance(key, str) else list(key)
+
+def key_from_fields(fields: list):
+	return fields[0] if len(fields) == 1 else tuple(fields)
+
+def open_join_partition(temp_dir: str, kind: str, partition: int, mode: str):
+	path = os.path.join(temp_dir, 'join-{}-{:03d}.csv'.format(kind, partition))
+	return open(path, mode, newline='', encoding='utf-8', errors='surrogatepass')
+
+def read_join_partition(temp_dir: str, kind: str, partition: int):
+	with open_join_partition(temp_dir, kind, partition, 'r') as f:
+		yield from csv.reader(f)
+	os.remove(f.name)
+
+def grace_join(haystack_rows, needle_rows, num_key_columns: int, build_from_needles: bool, join_type: str, num_needle_outputs: int, temp_dir: str):
+	"""Like join_rows, but for a build side too big to fit in memory. Both sides are split into partitions on disk by key, so that rows with the same key end up in the same partition, and each partition is joined separately. The results are merged back into haystack order at the end.
+
+	This assumes each partition of the build side fits in memory."""
+	for kind, rows in [ ('haystack', haystack_rows), ('needles', needle_rows) ]:
+		partition_files = [ open_join_partition(temp_dir, kind, i, 'w') for i in range(num_join_partitions) ]
+		partition_writers = [ csv.writer(f) for f in partition_files ]
+		if kind == 'haystack':
+			for sequence_number, key, haystack_values in rows:
+				partition_writers[key_partition(key)].writerow([ sequence_number ] + key_fields(key) + haystack_values)
+		else:
+			for key, needle_values in rows:
+				partition_writers[key_partition(key)].writerow(key_fields(key) + needle_values)
+		for f in partition_files:
+			f.close()
+
+	for partition in range(num_join_partitions):
+		partition_haystack_rows = ((int(fields[0]), key_from_fields(fields[1:1 + num_key_columns]), fields[1 + num_key_columns:]) for fields in read_join_partition(temp_dir, 'haystack', partition))
+		partition_needle_rows = ((key_from_fields(fields[:num_key_columns]), fields[num_key_columns:]) for fields in read_join_partition(temp_dir, 'needles', partition))
+		with open_join_partition(temp_dir, 'output', partition, 'w') as f:
+			writer = csv.writer(f)
+			for sequence_number, row in join_rows(partition_haystack_rows, partition_needle_rows, build_from_needles, join_type, num_needle_outputs):
+				writer.writerow([ sequence_number ] + row)
+
+	partition_output_rows = [ ((int(fields[0]), fields[1:]) for fields in read_join_partition(temp_dir, 'output', partition)) for partition in range(num_join_partitions) ]
+	yield from heapq.merge(*partition_output_rows, key=operator.itemgetter(0))
+
+def join_haystack(needle_path: pathlib.Path, needle_columns: list, haystack_path: pathlib.Path, haystack_columns: list, writer: csv.writer, opts: argparse.Namespace, temp_dir: str, previous_header: list=None):
+	"Write the join (of the type given by opts.join) of the haystack file with the needle file, in haystack order, preceded by the header of the output unless it's the same as previous_header. Returns the header."
+	needle_header = read_header(needle_path)
+	haystack_header = read_header(haystack_path)
+	if opts.join == 'anti':
+		needle_output_indexes = []
+	else:
+		needle_output_indexes = output_indexes(needle_header, opts.needle_output_columns, needle_columns, 'Needle')
+	haystack_output_indexes = output_indexes(haystack_header, opts.haystack_output_columns, [], 'Haystack')
+
+	header = [ haystack_header[i] for i in haystack_output_indexes ] + [ needle_header[i] for i in needle_output_indexes ]
+	if header != previous_header:
+		writer.writerow(header)
+
+	def haystack_rows():
+		for sequence_number, (key, haystack_values) in enumerate(read_join_rows(haystack_path, haystack_columns, haystack_output_indexes, 'Haystack')):
+			yield sequence_number, key, haystack_values
+	def needle_rows():
+		return read_join_rows(needle_path, needle_columns, needle_output_indexes, 'Needle')
+
+	# Build the hash table from whichever side is smaller.
+	build_from_needles = os.path.getsize(needle_path) <= os.path.getsize(haystack_path)
+	try:
+		for sequence_number, row in join_rows(haystack_rows(), needle_rows(), build_from_needles, opts.join, len(needle_output_indexes), opts.memory_budget):
+			writer.writerow(row)
+	except OverMemoryBudget:
+		print('Join (building from {} rows) exceeds memory budget; partitioning both sides of the join on disk'.format('needle' if build_from_needles else 'haystack'), file=sys.stderr)
+		for sequence_number, row in grace_join(haystack_rows(), needle_rows(), len(needle_columns), build_from_needles, opts.join, len(needle_output_indexes), temp_dir):
+			writer.writerow(row)
+
+	return header
+
+# Set up in each worker process by init_haystack_worker.
+worker_needles = None
+
+def init_haystack_worker(needle_file_path: str):
+	global worker_needles
+	worker_needles = NeedleDigestFile(needle_file_path)
+
+def filter_haystack_to_file(job: tuple):
+	"Worker function for --jobs. job is (haystack_path, haystack_columns, output_path, encoding). Filter one haystack file into a CSV file at output_path, starting with its header. Returns the header."
+	haystack_path, haystack_columns, output_path, encoding = job
+	with open(output_path, 'w', newline='', encoding=encoding) as f_out:
+		return filter_haystack(worker_needles, haystack_path, haystack_columns, csv.writer(f_out))
+
+def find_common(needle_path: pathlib.Path, needle_columns: list, haystack_paths: list, haystack_columns: list, opts: argparse.Namespace):
+	if opts.assume_sorted:
+		writer = csv.writer(sys.stdout)
+		header = None
+		for haystack_path in haystack_paths:
+			header = filter_haystack_sorted(needle_path, needle_columns, haystack_path, haystack_columns, writer, previous_header=header)
+		return
+
+	with tempfile.TemporaryDirectory(prefix='csv_common-') as temp_dir:
+		if opts.join:
+			writer = csv.writer(sys.stdout)
+			header = None
+			for haystack_path in haystack_paths:
+				header = join_haystack(needle_path, needle_columns, haystack_path, haystack_columns, writer, opts, temp_dir, previous_header=header)
+			return
+
+		if opts.cache_dir is not None or opts.jobs > 1:
+			needles = open_needle_file(needle_path, needle_columns, opts.memory_budget, opts.cache_dir, temp_dir)
+		else:
+			needles = load_needles(needle_path, needle_columns, opts.memory_budget, temp_dir)
+
+		header = None
+		if opts.jobs > 1 and len(haystack_paths) > 1:
+			# Each worker filters a whole haystack file into a temporary file, using its own mapping of the same digest file. The results are copied to stdout in order.
+			encoding = sys.stdout.encoding
+			jobs = [ (haystack_path, haystack_columns, os.path.join(temp_dir, 'haystack-{:d}.csv'.format(i)), encoding) for i, haystack_path in enumerate(haystack_paths) ]
+			with multiprocessing.Pool(opts.jobs, initializer=init_haystack_worker, initargs=(needles.path,)) as pool:
+				for job, haystack_header in zip(jobs, pool.imap(filter_haystack_to_file, jobs)):
+					output_path = job[2]
+					sys.stdout.flush()
+					with open(output_path, 'rb') as f:
+						if haystack_header == header:
+							# Skip the repeated header.
+							header_text = io.StringIO()
+							csv.writer(header_text).writerow(header)
+							f.seek(len(header_text.getvalue().encode(encoding)))
+						shutil.copyfileobj(f, sys.stdout.buffer)
+					os.remove(output_path)
+					header = haystack_header
+		else:
+			writer = csv.writer(sys.stdout)
+			for haystack_path in haystack_paths:
+				header = filter_haystack(needles, haystack_path, haystack_columns, writer, previous_header=header)
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Prints rows from one CSV file if a particular column matches values from a column of another CSV file.')
+	parser.add_argument('--memory-budget', type=parse_byte_count, default=None, help='Approximate amount of memory to hold needle values in, in bytes, optionally followed by K, M, G, or T. If the needle values need more than that, they are moved to a temporary file on disk, with a Bloom filter in memory to quickly rule out most haystack values that are not needles. Defaults to no limit.')
+	parser.add_argument('--cache-dir', type=pathlib.Path, default=None, help='Directory in which to keep a digest file of the needle column, to be memory-mapped by later runs against the same needle file instead of reading it again. A digest file is rebuilt if the needle file\'s size or modification time changes.')
+	parser.add_argument('--haystack', type=pathlib.Path, action='append', dest='more_haystack_paths', default=[], help='Path to another haystack file to search, with the same haystack column. Can be used multiple times. Matches are printed in the order the haystack files were given, with a header wherever it differs from the previous one.')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Search this many haystack files at once, in separate processes sharing one digest file of the needle column (in the cache directory, if any, or else a temporary one).')
+	parser.add_argument('--assume-sorted', action='store_true', default=False, help='Assume that the needle file and every haystack file are sorted by their key columns, and find matches by merging them instead of loading the needle values. This reads each file once and holds only one row of each in memory, and exits with an error if either file turns out not to be sorted. Ignores --memory-budget, --cache-dir, and --jobs.')
+	parser.add_argument('--join', choices=join_types, default=None, help='Instead of printing matching haystack rows as they are, join them with the needle rows they match, like a database join. "inner" prints each haystack row combined with each needle row it matches; "left" does the same, but also prints haystack rows that match no needle rows, with empty needle columns; "anti" prints only haystack rows that match no needle rows. Rows are printed in haystack order. The hash table is built from whichever file is smaller; if that side exceeds --memory-budget, both sides are partitioned by key into temporary files on disk and joined one partition at a time. Ignores --cache-dir and --jobs.')
+	parser.add_argument('--needle-output-columns', type=parse_key_columns, default=None, help='Comma-separated list of columns from the needle file to include in the output of --join. Defaults to every needle column but the needle columns being matched.')
+	parser.add_argument('--haystack-output-columns', type=parse_key_columns, default=None, help='Comma-separated list of columns from the haystack file to include in the output of --join. Defaults to every haystack column.')
 	parser.add_argument('needle_path', type=pathlib.Path, help='Path to a CSV file to load needle values from.')
-	parser.add_argument('needle_column', type=str, help='Column in the needles file that contains needle values.')
+	parser.add_argument('needle_column', type=str, help='Column in the needles file that contains needle values. Can be a comma-separated list of columns, whose values together make up each needle; quote any column name that contains a comma, as in CSV.')
 	parser.add_argument('haystack_path', type=pathlib.Path, help='Path to a CSV file whose haystack column is the haystack.')
-	parser.add_argument('haystack_column', type=str, help='Column in the haystack file to search for needle values. Any row that has a needle value in this column is considered a match.')
+	parser.add_argument('haystack_column', type=str, help='Column in the haystack file to search for needle values. Any row that has a needle value in this column is considered a match. Can be a comma-separated list of columns (quoted as in CSV), matched in order to the needle columns.')
 	opts = parser.parse_args()
-	sys.exit(find_common(opts.needle_path, opts.needle_column, opts.haystack_path, opts.haystack_column))
+	needle_columns = parse_key_columns(opts.needle_column)
+	haystack_columns = parse_key_columns(opts.haystack_column)
+	if len(needle_columns) != len(haystack_columns):
+		sys.exit('The number of needle columns ({:n}) and haystack columns ({:n}) must be the same'.format(len(needle_columns), len(haystack_columns)))
+	if opts.join and opts.assume_sorted:
+		sys.exit('--join does not support --assume-sorted')
+
+	sys.exit(find_common(opts.needle_path, needle_columns, [ opts.haystack_path ] + opts.more_haystack_paths, haystack_columns, opts))
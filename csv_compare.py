@@ -5,7 +5,15 @@ import sys
 import pathlib
 import argparse
 import csv
+import hashlib
+import io
+import json
 import locale
+import math
+import multiprocessing
+import shutil
+import tempfile
+import zlib
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -25,27 +33,154 @@ def prefix_row(orig_row: list, prefix: str):
 	if not orig_row: return orig_row
 	return [ prefix + str(orig_row[0]) ] + orig_row[1:]
 
+class Differences:
+	"Tallies the differences found between two tables, writing out each one that is to be reported as it's found."
+	def __init__(self, writer: csv.writer, report_names: list, max_differences=None):
+		self.writer = writer
+		self.max_differences = max_differences
+
+		self.report_each_missing_left = ('each_missing_left' in report_names)
+		self.report_each_missing_right = ('each_missing_right' in report_names)
+		self.report_each_unequal = ('each_unequal' in report_names)
+		self.report_each_equal = ('each_equal' in report_names)
+		self.report_count_missing_left = ('count_missing_left' in report_names)
+		self.report_count_missing_right = ('count_missing_right' in report_names)
+		self.report_count_unequal = ('count_unequal' in report_names)
+		self.report_count_left = ('count_left' in report_names)
+		self.report_count_right = ('count_right' in report_names)
+		self.report_count_equal = ('count_equal' in report_names)
+
+		self.left_missing_entries = 0
+		self.right_missing_entries = 0
+		self.left_row_count = 0
+		self.right_row_count = 0
+		self.matched_rows_unequal = 0
+		self.matched_rows_equal = 0
+
+	def missing_from_right(self, left_row: list):
+		"Record that the right table has no row matching left_row."
+		if self.report_each_missing_right:
+			self.writer.writerow(prefix_row(left_row, '-'))
+		self.right_missing_entries += 1
+
+	def missing_from_left(self, right_row: list):
+		"Record that the left table has no row matching right_row. right_row may be None if each_missing_left isn't being reported."
+		if self.report_each_missing_left:
+			self.writer.writerow(prefix_row(right_row, '+'))
+		self.left_missing_entries += 1
+
+	def matched(self, left_row: list, right_row: list, equal: bool):
+		"Record that two rows were matched together, and whether their checked values were equal. right_row may be None if equal, or if each_unequal isn't being reported."
+		if equal:
+			if self.report_each_equal:
+				self.writer.writerow(prefix_row(left_row, ' '))
+			self.matched_rows_equal += 1
+		else:
+			self.matched_rows_unequal += 1
+			if self.report_each_unequal:
+				self.writer.writerow(prefix_row(left_row, '-'))
+				self.writer.writerow(prefix_row(right_row, '+'))
+
+	def reached_max_differences(self):
+		num_differences = (self.left_missing_entries + self.right_missing_entries + self.matched_rows_unequal)
+		return self.max_differences and num_differences >= self.max_differences
+
+	def print_counts(self):
+		if self.report_count_missing_left:
+			print('Missing from the left table:\t{:n}'.format(self.left_missing_entries))
+		if self.report_count_missing_right:
+			print('Missing from the right table:\t{:n}'.format(self.right_missing_entries))
+		if self.report_count_unequal:
+			print('Unequal matched rows:\t{:n}'.format(self.matched_rows_unequal))
+		if self.report_count_equal:
+			print('Equal matched rows:\t{:n}'.format(self.matched_rows_equal))
+		if self.report_count_left:
+			print('Rows in the left table:\t{:n}'.format(self.left_row_count))
+		if self.report_count_right:
+			print('Rows in the right table:\t{:n}'.format(self.right_row_count))
+
+	def results(self):
+		return self.left_missing_entries, self.right_missing_entries, self.matched_rows_unequal
+
+	def counts(self):
+		return [ self.left_missing_entries, self.right_missing_entries, self.matched_rows_unequal, self.matched_rows_equal, self.left_row_count, self.right_row_count ]
+
+	def add_counts(self, counts: list):
+		"Add the counts of another Differences (as returned by its counts method) to these."
+		self.left_missing_entries += counts[0]
+		self.right_missing_entries += counts[1]
+		self.matched_rows_unequal += counts[2]
+		self.matched_rows_equal += counts[3]
+		self.left_row_count += counts[4]
+		self.right_row_count += counts[5]
+
+def compare_sorted_rows(left_rows, right_rows, left_match_indexes: list, right_match_indexes: list, left_check_equal_indexes: list, right_check_equal_indexes: list, differences: Differences, to_the_end: bool=False):
+	"""Compare two iterators of rows that are both sorted by their match values, tallying the differences. Returns False if the maximum number of differences was reached, or True otherwise.
+
+	If to_the_end, the rows left on one side after the other side runs out are all reported as missing from the other side. Otherwise, the comparison stops as soon as either side runs out, as compare_tables_sorted always has."""
+	def next_left_row():
+		left_row = next(left_rows, None)
+		if left_row is not None:
+			differences.left_row_count += 1
+		return left_row
+	def next_right_row():
+		right_row = next(right_rows, None)
+		if right_row is not None:
+			differences.right_row_count += 1
+		return right_row
+
+	left_row = next_left_row()
+	right_row = next_right_row()
+	while left_row and right_row:
+		left_match_values = get_from_indexes(left_row, left_match_indexes)
+		right_match_values = get_from_indexes(right_row, right_match_indexes)
+
+		if left_match_values < right_match_values:
+			# The right table has skipped an entry.
+			differences.missing_from_right(left_row)
+			left_row = next_left_row()
+		elif left_match_values > right_match_values:
+			# The left table has skipped an entry.
+			differences.missing_from_left(right_row)
+			right_row = next_right_row()
+		else:
+			# We've matched two rows together. Compare the values that are expected to also be equal.
+			left_check_equal_values = get_from_indexes(left_row, left_check_equal_indexes)
+			right_check_equal_values = get_from_indexes(right_row, right_check_equal_indexes)
+			differences.matched(left_row, right_row, left_check_equal_values == right_check_equal_values)
+
+			left_row = next_left_row()
+			if left_row is None and not to_the_end:
+				break
+			right_row = next_right_row()
+
+		if differences.reached_max_differences():
+			return False
+
+	if to_the_end:
+		while left_row is not None:
+			differences.missing_from_right(left_row)
+			if differences.reached_max_differences():
+				return False
+			left_row = next_left_row()
+		while right_row is not None:
+			differences.missing_from_left(right_row)
+			if differences.reached_max_differences():
+				return False
+			right_row = next_right_row()
+
+	return True
+
 def compare_tables_sorted(left_path: pathlib.Path, right_path: pathlib.Path, writer: csv.writer, match_keys: list, check_equal_keys: list, report_names: list, max_differences=None):
 	"Print every row for which all of the values for match keys are equal and the values for check_equal_keys are not equal. This implementation assumes both tables are already sorted by all of the match_keys. Returns a tuple of Booleans indicating whether the left table was missing entries found in the right, the right table was missing entries from the left, and any matched rows were found to be unequal in the checked columns. The return values may not be comprehensive if max_differences (if not None, an integer limiting the number of differences before returning failure) is reached."
 
-	left_missing_entries = 0
-	right_missing_entries = 0
-	left_row_count = 0
-	right_row_count = 0
-	matched_rows_unequal = 0
-	matched_rows_equal = 0
-
-	report_each_missing_left = ('each_missing_left' in report_names)
-	report_each_missing_right = ('each_missing_right' in report_names)
-	report_each_unequal = ('each_unequal' in report_names)
-	report_each_equal = ('each_equal' in report_names)
-	report_count_missing_left = ('count_missing_left' in report_names)
-	report_count_missing_right = ('count_missing_right' in report_names)
-	report_count_unequal = ('count_unequal' in report_names)
-	report_count_left = ('count_left' in report_names)
-	report_count_right = ('count_right' in report_names)
-	report_count_equal = ('count_equal' in report_names)
+	differences = Differences(writer, report_names, max_differences)
+	compare_sorted_files(left_path, right_path, differences, match_keys, check_equal_keys)
+	differences.print_counts()
+	return differences.results()
 
+def compare_sorted_files(left_path: pathlib.Path, right_path: pathlib.Path, differences: Differences, match_keys: list, check_equal_keys: list, to_the_end: bool=False):
+	"Compare two tables that are both sorted by their match columns (see compare_sorted_rows)."
 	with open(left_path, 'r') as f_left:
 		with open(right_path, 'r') as f_right:
 			left_reader = csv.reader(f_left)
@@ -65,79 +200,502 @@ def compare_tables_sorted(left_path: pathlib.Path, right_path: pathlib.Path, wri
 				left_check_equal_indexes.append(left_header.index(k))
 				right_check_equal_indexes.append(right_header.index(k))
 
-			left_row = next(left_reader); left_row_count += 1
-			right_row = next(right_reader); right_row_count += 1
-			while left_row and right_row:
-				try:
-					left_match_values = get_from_indexes(left_row, left_match_indexes)
-					right_match_values = get_from_indexes(right_row, right_match_indexes)
-
-					if left_match_values < right_match_values:
-						# The right table has skipped an entry.
-						if report_each_missing_right:
-							writer.writerow(prefix_row(left_row, '-'))
-						right_missing_entries += 1
-						left_row = next(left_reader); left_row_count += 1
-					elif left_match_values > right_match_values:
-						# The left table has skipped an entry.
-						if report_each_missing_left:
-							writer.writerow(prefix_row(right_row, '+'))
-						left_missing_entries += 1
-						right_row = next(right_reader); right_row_count += 1
+			compare_sorted_rows(left_reader, right_reader, left_match_indexes, right_match_indexes, left_check_equal_indexes, right_check_equal_indexes, differences, to_the_end)
+
+# Copied from csv_select
+def parse_byte_count(count_str: str):
+	"Parse a number of bytes, optionally followed by K, M, G, or T (powers of 1024)."
+	multipliers = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+	count_str = count_str.strip().upper().rstrip('B')
+	multiplier = 1
+	if count_str and count_str[-1] in multipliers:
+		multiplier = multipliers[count_str[-1]]
+		count_str = count_str[:-1]
+	return int(float(count_str) * multiplier)
+
+# Copied from csv_select
+def iter_records_with_offsets(binary_file, encoding: str, offset: int=0):
+	"Parse CSV records from a file opened in binary mode and positioned at offset (the start of a record). Yields (offset, length, row) for each record, where offset and length locate the bytes of that record, including its line break(s)."
+	position = offset
+	def lines():
+		nonlocal position
+		for line in binary_file:
+			position += len(line)
+			if line.endswith(b'\r\n'):
+				# Translate line breaks the way a file opened in text mode would.
+				line = line[:-2] + b'\n'
+			yield line.decode(encoding)
+
+	record_start = offset
+	# csv.reader pulls lines only as it needs them, so after each record, position is the end of that record.
+	for row in csv.reader(lines()):
+		yield record_start, position - record_start, row
+		record_start = position
+
+def read_record_at(binary_file, offset: int, length: int, encoding: str):
+	"Read and parse the record at offset in a file opened in binary mode."
+	binary_file.seek(offset)
+	record = binary_file.read(length).decode(encoding)
+	# Translate line breaks the way a file opened in text mode would.
+	return next(csv.reader(io.StringIO(record, newline=None)))
+
+def check_digest(check_equal_values: list):
+	return hashlib.blake2b(repr(check_equal_values).encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+# Approximate memory cost of one row of the right table in compare_hashed_in_memory's hash table, not counting the characters of its match values.
+bytes_per_hashed_row = 250
+
+# Number of partitions each table is split into when the right table's hash table doesn't fit in the memory budget.
+num_compare_partitions = 256
+
+class OverMemoryBudget(Exception):
+	pass
+
+def compare_hashed_in_memory(left_path: pathlib.Path, right_path: pathlib.Path, differences: Differences, match_keys: list, check_equal_keys: list, memory_budget: int=None):
+	"""Compare two tables in any order. The right table is read into a hash table from match values to a digest of the checked values (and the location of the row, to read it back if it has to be reported), and then the left table is streamed past it. Rows with the same match values are matched up in the order they appear in each table, as they would be if both tables were sorted.
+
+	Rows missing from the right table and matched rows are reported in left table order as they're found; rows missing from the left table are reported at the end, in right table order. Raises OverMemoryBudget, before reporting anything, if the hash table would take more than memory_budget bytes (approximately)."""
+	encoding = locale.getpreferredencoding(False)
+	with open(right_path, 'rb') as f_right:
+		records = iter_records_with_offsets(f_right, encoding)
+		offset, length, right_header = next(records)
+		right_match_indexes = [ right_header.index(k) for k in match_keys ]
+		right_check_equal_indexes = [ right_header.index(k) for k in check_equal_keys ]
+
+		hashed_rows = {}
+		hashed_rows_size = 0
+		right_row_count = 0
+		for offset, length, right_row in records:
+			right_row_count += 1
+			right_match_values = tuple(get_from_indexes(right_row, right_match_indexes))
+			hashed_rows.setdefault(right_match_values, []).append((check_digest(get_from_indexes(right_row, right_check_equal_indexes)), offset, length))
+			if memory_budget is not None:
+				hashed_rows_size += sum(map(len, right_match_values)) + bytes_per_hashed_row
+				if hashed_rows_size > memory_budget:
+					raise OverMemoryBudget()
+		differences.right_row_count += right_row_count
+
+		# Each list of rows with the same match values is consumed from the front, so reverse it to pop them off the end.
+		for entries in hashed_rows.values():
+			entries.reverse()
+
+		with open(left_path, 'r') as f_left:
+			left_reader = csv.reader(f_left)
+			left_header = next(left_reader)
+			left_match_indexes = [ left_header.index(k) for k in match_keys ]
+			left_check_equal_indexes = [ left_header.index(k) for k in check_equal_keys ]
+
+			for left_row in left_reader:
+				differences.left_row_count += 1
+				left_match_values = tuple(get_from_indexes(left_row, left_match_indexes))
+				entries = hashed_rows.get(left_match_values)
+				if not entries:
+					differences.missing_from_right(left_row)
+				else:
+					right_digest, offset, length = entries.pop()
+					if not entries:
+						del hashed_rows[left_match_values]
+					if check_digest(get_from_indexes(left_row, left_check_equal_indexes)) == right_digest:
+						differences.matched(left_row, None, True)
 					else:
-						# We've matched two rows together. Compare the values that are expected to also be equal.
-						left_check_equal_values = get_from_indexes(left_row, left_check_equal_indexes)
-						right_check_equal_values = get_from_indexes(right_row, right_check_equal_indexes)
-						if left_check_equal_values == right_check_equal_values:
-							if report_each_equal:
-								writer.writerow(prefix_row(left_row, ' '))
-							matched_rows_equal += 1
-						else:
-							matched_rows_unequal += 1
-							if report_each_unequal:
-								writer.writerow(prefix_row(left_row, '-'))
-								writer.writerow(prefix_row(right_row, '+'))
-
-						left_row = next(left_reader); left_row_count += 1
-						right_row = next(right_reader); right_row_count += 1
-
-					num_differences = (left_missing_entries + right_missing_entries + matched_rows_unequal)
-					if max_differences and num_differences >= max_differences:
-						break
-				except StopIteration:
+						right_row = read_record_at(f_right, offset, length, encoding) if differences.report_each_unequal else None
+						differences.matched(left_row, right_row, False)
+
+				if differences.reached_max_differences():
+					return
+
+		# Whatever is left in the hash table had no match in the left table.
+		unmatched = sorted((offset, length) for entries in hashed_rows.values() for right_digest, offset, length in entries)
+		hashed_rows = None
+		for offset, length in unmatched:
+			right_row = read_record_at(f_right, offset, length, encoding) if differences.report_each_missing_left else None
+			differences.missing_from_left(right_row)
+			if differences.reached_max_differences():
+				return
+
+def partition_table(path: pathlib.Path, match_keys: list, temp_dir: str, side: str):
+	"Split a table into num_compare_partitions tables in temp_dir, each with the same header, by a hash of each row's match values. Rows stay in the same order within each partition. Returns the paths of the partitions."
+	partition_paths = [ os.path.join(temp_dir, '{}-{:03d}.csv'.format(side, i)) for i in range(num_compare_partitions) ]
+	with open(path, 'r') as f:
+		reader = csv.reader(f)
+		header = next(reader)
+		match_indexes = [ header.index(k) for k in match_keys ]
+
+		partition_files = [ open(partition_path, 'w', newline='') for partition_path in partition_paths ]
+		partition_writers = [ csv.writer(partition_file) for partition_file in partition_files ]
+		for writer in partition_writers:
+			writer.writerow(header)
+		for row in reader:
+			match_values = get_from_indexes(row, match_indexes)
+			partition = check_digest(match_values)[0] % num_compare_partitions
+			partition_writers[partition].writerow(row)
+		for partition_file in partition_files:
+			partition_file.close()
+
+	return partition_paths
+
+def compare_tables_hashed(left_path: pathlib.Path, right_path: pathlib.Path, writer: csv.writer, match_keys: list, check_equal_keys: list, report_names: list, max_differences=None, memory_budget: int=None):
+	"Equivalent to compare_tables_sorted, but for tables in any order. The rows each report covers are the same, but they come out in a different order (see compare_hashed_in_memory). If the right table doesn't fit in memory_budget, both tables are split into partitions on disk by match values, and each pair of partitions is compared separately."
+	differences = Differences(writer, report_names, max_differences)
+	compare_hashed(left_path, right_path, differences, match_keys, check_equal_keys, memory_budget)
+	differences.print_counts()
+	return differences.results()
+
+def compare_hashed(left_path: pathlib.Path, right_path: pathlib.Path, differences: Differences, match_keys: list, check_equal_keys: list, memory_budget: int=None):
+	"Compare two tables in any order (see compare_tables_hashed)."
+	try:
+		compare_hashed_in_memory(left_path, right_path, differences, match_keys, check_equal_keys, memory_budget)
+	except OverMemoryBudget:
+		print('Right table exceeds memory budget; partitioning both tables on disk', file=sys.stderr)
+		with tempfile.TemporaryDirectory(prefix='csv_compare-') as temp_dir:
+			left_partition_paths = partition_table(left_path, match_keys, temp_dir, 'left')
+			right_partition_paths = partition_table(right_path, match_keys, temp_dir, 'right')
+			for left_partition_path, right_partition_path in zip(left_partition_paths, right_partition_paths):
+				compare_hashed_in_memory(left_partition_path, right_partition_path, differences, match_keys, check_equal_keys)
+				if differences.reached_max_differences():
 					break
 
-	if report_count_missing_left:
-		print('Missing from the left table:\t{:n}'.format(left_missing_entries))
-	if report_count_missing_right:
-		print('Missing from the right table:\t{:n}'.format(right_missing_entries))
-	if report_count_unequal:
-		print('Unequal matched rows:\t{:n}'.format(matched_rows_unequal))
-	if report_count_equal:
-		print('Equal matched rows:\t{:n}'.format(matched_rows_equal))
-	if report_count_left:
-		print('Rows in the left table:\t{:n}'.format(left_row_count))
-	if report_count_right:
-		print('Rows in the right table:\t{:n}'.format(right_row_count))
-
-	return left_missing_entries, right_missing_entries, matched_rows_unequal
+# Copied from csv_select
+# Size of the byte ranges that --jobs divides the input into. Each range is read whole by one worker process.
+parallel_chunk_size = 32 * 1024 * 1024
+
+def find_header_end(path: pathlib.Path):
+	"Return the byte offset just past the header record of the file at path."
+	offset = 0
+	quote_count = 0
+	with open(path, 'rb') as f:
+		for line in f:
+			offset += len(line)
+			quote_count += line.count(b'"')
+			if quote_count % 2 == 0:
+				break
+	return offset
+
+def scan_for_record_starts(path: pathlib.Path, start: int, end: int):
+	"""Count the quote characters in the given byte range of the file at path, and find where records could start within that range.
+
+	Any line break that follows an even number of quotes (counting from the start of the file) ends a record; any line break within a quoted field follows an odd number. Since the quotes before this range haven't been counted yet, return (quote_count, even_start, odd_start): the number of quotes in the range, the offset just past the first line break after an even number of quotes counted from start, and likewise for an odd number. Either offset is None if there is no such line break in the range.
+	This assumes quotes appear only around quoted fields, as csv.writer writes them."""
+	with open(path, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+
+	starts = [ None, None ]
+	quote_count = 0
+	scanned = 0
+	line_end = data.find(b'\n')
+	while line_end >= 0:
+		quote_count += data.count(b'"', scanned, line_end)
+		scanned = line_end
+		parity = quote_count % 2
+		if starts[parity] is None:
+			starts[parity] = start + line_end + 1
+			if None not in starts:
+				break
+		# The parity can't change until the next quote, so skip to the first line break after it.
+		next_quote = data.find(b'"', line_end)
+		if next_quote < 0:
+			break
+		line_end = data.find(b'\n', next_quote)
+
+	return data.count(b'"'), starts[0], starts[1]
+
+def record_aligned_ranges(path: pathlib.Path, start: int, pool):
+	"Divide the file at path, from start (which must be the start of a record) to the end, into byte ranges of roughly parallel_chunk_size that each begin and end on a record boundary. Uses pool to scan the file in parallel. Returns a list of (start, end) pairs."
+	size = os.path.getsize(path)
+	range_starts = list(range(start, size, parallel_chunk_size))
+	scans = pool.starmap(scan_for_record_starts, [ (path, range_start, min(range_start + parallel_chunk_size, size)) for range_start in range_starts ])
+
+	boundaries = [ start ]
+	quotes_before = 0
+	for i, (quote_count, even_start, odd_start) in enumerate(scans):
+		if i > 0:
+			record_start = even_start if quotes_before % 2 == 0 else odd_start
+			if record_start is not None and record_start < size:
+				boundaries.append(record_start)
+		quotes_before += quote_count
+	boundaries.append(size)
+
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+def with_line_break(record: bytes):
+	"Return the bytes of a record, adding a line break if it has none (as the last record of a file may not), so that another record can follow it."
+	return record if record.endswith((b'\n', b'\r')) else record + b'\n'
+
+def split_records(data: bytes, encoding: str, num_fields: int):
+	"""Yield (record, fields) for each CSV record in data, where record is its bytes and fields are at least its first num_fields fields (as csv.reader would parse them).
+
+	A line with an even number of quotes is a whole record; if none of those fields are quoted, they are simply split off on commas. Any other record is parsed by csv.reader. This assumes quotes appear only around quoted fields, as csv.writer writes them."""
+	quoted_lines = []
+	quote_count = 0
+	for line in data.splitlines(keepends=True):
+		if not quoted_lines:
+			if b'"' not in line:
+				yield line, line.rstrip(b'\r\n').decode(encoding).split(',', num_fields)
+				continue
+			elif line.count(b'"') % 2 == 0:
+				fields = line.split(b',', num_fields)[:num_fields]
+				if b'"' not in b''.join(fields):
+					yield line, [ field.rstrip(b'\r\n').decode(encoding) for field in fields ]
+					continue
+		quoted_lines.append(line)
+		quote_count += line.count(b'"')
+		if quote_count % 2 == 0:
+			record = b''.join(quoted_lines)
+			yield record, next(csv.reader(io.StringIO(record.decode(encoding), newline=None)))
+			quoted_lines = []
+			quote_count = 0
+	if quoted_lines:
+		record = b''.join(quoted_lines)
+		yield record, next(csv.reader(io.StringIO(record.decode(encoding), newline=None)))
+
+def range_partition_path(temp_dir: str, side: str, range_number: int, partition: int):
+	return os.path.join(temp_dir, '{}-{:05d}-{:03d}.csv'.format(side, range_number, partition))
+
+def partition_range(job: tuple):
+	"""Worker function for --jobs. job is (path, side, range_number, start, end, match_indexes, num_partitions, temp_dir, encoding). Split the records in a byte range of a table into num_partitions files in temp_dir (see range_partition_path) by a hash of their match values, keeping them in order. Each record's bytes are copied as is. The files have no header.
+
+	This uses a different hash than partition_table does (a cheaper one, as this is done to every row), so that a worker that has to partition its tables further can use all of its partitions."""
+	path, side, range_number, start, end, match_indexes, num_partitions, temp_dir, encoding = job
+	with open(path, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+
+	partition_records = [ [] for i in range(num_partitions) ]
+	for record, row in split_records(data, encoding, max(match_indexes) + 1):
+		match_values = get_from_indexes(row, match_indexes)
+		partition_records[zlib.crc32('\0'.join(match_values).encode('utf-8', 'surrogatepass')) % num_partitions].append(record)
+	# The last record of the file may lack a line break, and the partitions of other ranges will follow this one's.
+	for records in partition_records:
+		if records:
+			records[-1] = with_line_break(records[-1])
+
+	for partition, records in enumerate(partition_records):
+		with open(range_partition_path(temp_dir, side, range_number, partition), 'wb') as f:
+			f.write(b''.join(records))
+
+def assemble_partition(header: bytes, range_partition_paths: list, path: str):
+	"Write a table to path made of the header followed by the partitions of each byte range of a table (from partition_range), in order, removing them."
+	with open(path, 'wb') as f:
+		f.write(header)
+		for range_partition_path in range_partition_paths:
+			with open(range_partition_path, 'rb') as range_partition_file:
+				shutil.copyfileobj(range_partition_file, f)
+			os.remove(range_partition_path)
+
+def compare_partition(job: tuple):
+	"Worker function for --jobs. job is (left_tables, right_tables, temp_dir, partition, output_path, encoding, match_keys, check_equal_keys, report_names, max_differences, assume_sorted, memory_budget), where each of left_tables and right_tables is (header, number of byte ranges). Put together one partition of each table from the partitions of their byte ranges, and compare them, writing the reports of each difference to a CSV file at output_path. Returns the counts of the Differences."
+	left_table, right_table, temp_dir, partition, output_path, encoding, match_keys, check_equal_keys, report_names, max_differences, assume_sorted, memory_budget = job
+	partition_paths = []
+	for side, (header, num_ranges) in [ ('left', left_table), ('right', right_table) ]:
+		partition_path = os.path.join(temp_dir, '{}-{:03d}.csv'.format(side, partition))
+		assemble_partition(header, [ range_partition_path(temp_dir, side, range_number, partition) for range_number in range(num_ranges) ], partition_path)
+		partition_paths.append(partition_path)
+	left_path, right_path = partition_paths
+
+	with open(output_path, 'w', newline='', encoding=encoding) as f_out:
+		differences = Differences(csv.writer(f_out), report_names, max_differences)
+		if assume_sorted:
+			compare_sorted_files(left_path, right_path, differences, match_keys, check_equal_keys, to_the_end=True)
+		else:
+			compare_hashed(left_path, right_path, differences, match_keys, check_equal_keys, memory_budget)
+	os.remove(left_path)
+	os.remove(right_path)
+	return differences.counts()
+
+def compare_tables_parallel(left_path: pathlib.Path, right_path: pathlib.Path, writer: csv.writer, match_keys: list, check_equal_keys: list, report_names: list, max_differences=None, assume_sorted: bool=False, memory_budget: int=None, jobs: int=2):
+	"""Equivalent to compare_tables_sorted (if assume_sorted) or compare_tables_hashed, but splits both tables into one partition per job by a hash of the match values, and compares each pair of partitions in a separate worker process. Each partition's reports are printed together, in partition order, and the counts are added up.
+
+	The partitioning is done by the workers too: each table is divided into record-aligned byte ranges, each worker splits one range at a time into partitions, and each worker comparing a partition first puts that partition's pieces of each range back together in order. So partitions of sorted tables are still sorted. They are compared to the end, so rows at the end of either table that the other doesn't have are reported. Each partition stops at max_differences on its own, so the total can exceed it. The memory budget is divided among the workers."""
+	differences = Differences(writer, report_names, max_differences)
+	encoding = locale.getpreferredencoding(False)
+
+	with tempfile.TemporaryDirectory(prefix='csv_compare-') as temp_dir:
+		with multiprocessing.Pool(jobs) as pool:
+			tables = []
+			partition_jobs = []
+			for side, path in [ ('left', left_path), ('right', right_path) ]:
+				if not os.path.isfile(path):
+					# Can't be divided into byte ranges where it is, so copy it somewhere it can.
+					copy_path = os.path.join(temp_dir, '{}-input.csv'.format(side))
+					with open(path, 'rb') as f, open(copy_path, 'wb') as copy_file:
+						shutil.copyfileobj(f, copy_file)
+					path = copy_path
+				header_end = find_header_end(path)
+				with open(path, 'rb') as f:
+					header = with_line_break(f.read(header_end))
+				header_row = next(csv.reader(io.StringIO(header.decode(encoding), newline=None)))
+				match_indexes = [ header_row.index(k) for k in match_keys ]
+				byte_ranges = record_aligned_ranges(path, header_end, pool)
+				partition_jobs += [ (path, side, range_number, start, end, match_indexes, jobs, temp_dir, encoding) for range_number, (start, end) in enumerate(byte_ranges) ]
+				tables.append((header, len(byte_ranges)))
+			for result in pool.imap_unordered(partition_range, partition_jobs):
+				pass
+
+			left_table, right_table = tables
+			worker_memory_budget = memory_budget // jobs if memory_budget is not None else None
+			output_encoding = sys.stdout.encoding
+			job_args = [ (left_table, right_table, temp_dir, partition, os.path.join(temp_dir, 'output-{:03d}.csv'.format(partition)), output_encoding, match_keys, check_equal_keys, report_names, max_differences, assume_sorted, worker_memory_budget) for partition in range(jobs) ]
+			for job, counts in zip(job_args, pool.imap(compare_partition, job_args)):
+				output_path = job[4]
+				sys.stdout.flush()
+				with open(output_path, 'rb') as f:
+					shutil.copyfileobj(f, sys.stdout.buffer)
+				os.remove(output_path)
+				differences.add_counts(counts)
+
+	differences.print_counts()
+	return differences.results()
+
+def digests_path_for(path: pathlib.Path):
+	return path.with_name(path.name + '.csvdigests')
+
+def is_block_start(match_values: list, block_bits: int):
+	"Return True if a block should start at a row with these match values (if they differ from the previous row's): if the low block_bits bits of their hash are all zero."
+	match_hash = hashlib.blake2b(repr(match_values).encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+	return int.from_bytes(match_hash, 'little') & ((1 << block_bits) - 1) == 0
+
+def build_block_digests(path: pathlib.Path, match_keys: list, check_equal_keys: list, block_bits: int, encoding: str):
+	"""Divide a table that's sorted by its match columns into blocks, and digest the match and checked values of the rows in each block. Returns a list of [start, end, row_count, first_match_values, digest] for each block, with start and end being byte offsets.
+
+	The blocks are content-defined: a new one starts at any row whose match values differ from the previous row's and pass is_block_start. So two tables are split at the same keys wherever they both have those keys, no matter what else differs between them, and the blocks of one table can be lined up with those of another by their first match values."""
+	blocks = []
+	with open(path, 'rb') as binary_file:
+		records = iter_records_with_offsets(binary_file, encoding)
+		header_offset, header_length, header = next(records)
+		match_indexes = [ header.index(k) for k in match_keys ]
+		check_equal_indexes = [ header.index(k) for k in check_equal_keys ]
+
+		def finish_block(end):
+			blocks.append([ block_start, end, block_rows, block_match_values, block_digest.hexdigest() ])
+
+		block_start = header_offset + header_length
+		block_rows = 0
+		block_match_values = None
+		block_digest = hashlib.blake2b(digest_size=16)
+		previous_match_values = None
+		for offset, length, row in records:
+			match_values = get_from_indexes(row, match_indexes)
+			if block_rows and match_values != previous_match_values and is_block_start(match_values, block_bits):
+				finish_block(offset)
+				block_start = offset
+				block_rows = 0
+				block_digest = hashlib.blake2b(digest_size=16)
+			if not block_rows:
+				block_match_values = match_values
+			block_digest.update(repr((match_values, get_from_indexes(row, check_equal_indexes))).encode('utf-8', 'surrogatepass'))
+			block_rows += 1
+			previous_match_values = match_values
+		if block_rows:
+			finish_block(offset + length)
+
+	return blocks
+
+def block_digests(path: pathlib.Path, match_keys: list, check_equal_keys: list, block_bits: int):
+	"""Return the block digests of a sorted table (see build_block_digests), from its sidecar file if that was made for the same columns and block size and the table hasn't changed since; otherwise, build them and save them in a new sidecar file.
+
+	The sidecar file is JSON: an object describing the table, whose "blocks" are as returned by build_block_digests."""
+	stat = os.stat(path)
+	description = {
+		'match_columns': match_keys,
+		'check_columns': check_equal_keys,
+		'block_bits': block_bits,
+		'source_size': stat.st_size,
+		'source_mtime_ns': stat.st_mtime_ns,
+	}
+	try:
+		with open(digests_path_for(path), 'r') as digests_file:
+			digests = json.load(digests_file)
+		if all(digests.get(name) == value for name, value in description.items()):
+			return digests['blocks']
+	except (FileNotFoundError, ValueError):
+		pass
+
+	blocks = build_block_digests(path, match_keys, check_equal_keys, block_bits, locale.getpreferredencoding(False))
+	try:
+		with open(digests_path_for(path), 'w') as digests_file:
+			json.dump(dict(description, blocks=blocks), digests_file)
+	except OSError as e:
+		print('Could not save block digests for {}: {}'.format(path, e), file=sys.stderr)
+	return blocks
+
+def segment_boundaries(blocks: list, common_starts: set):
+	"Return the indexes of the blocks that start at any of common_starts, preceded by 0 and followed by the number of blocks, so that each consecutive pair of boundaries delimits a segment of blocks."
+	return [ 0 ] + [ i for i, block in enumerate(blocks) if i > 0 and tuple(block[3]) in common_starts ] + [ len(blocks) ]
+
+def read_rows_between(binary_file, start: int, end: int, encoding: str):
+	"Parse the records in a byte range of a file opened in binary mode."
+	binary_file.seek(start)
+	text = binary_file.read(end - start).decode(encoding)
+	return csv.reader(io.StringIO(text, newline=None))
+
+def compare_tables_by_blocks(left_path: pathlib.Path, right_path: pathlib.Path, writer: csv.writer, match_keys: list, check_equal_keys: list, report_names: list, max_differences=None, block_bits: int=10):
+	"""Equivalent to compare_tables_sorted, but compares both tables block by block first (see block_digests), and compares rows only where the blocks differ. Unlike compare_tables_sorted, this reports the rows at the end of either table that the other table doesn't have.
+
+	Both tables are divided into segments at the keys where both of them start a block. A segment that is a single block in both tables with the same digest in both is counted as equal rows without being read; any other segment is read from both tables and compared row by row."""
+	differences = Differences(writer, report_names, max_differences)
+	encoding = locale.getpreferredencoding(False)
+
+	left_blocks = block_digests(left_path, match_keys, check_equal_keys, block_bits)
+	right_blocks = block_digests(right_path, match_keys, check_equal_keys, block_bits)
+	common_starts = set(tuple(block[3]) for block in left_blocks[1:]) & set(tuple(block[3]) for block in right_blocks[1:])
+	left_boundaries = segment_boundaries(left_blocks, common_starts)
+	right_boundaries = segment_boundaries(right_blocks, common_starts)
+
+	with open(left_path, 'rb') as f_left, open(right_path, 'rb') as f_right:
+		left_header = next(read_rows_between(f_left, 0, left_blocks[0][0] if left_blocks else os.path.getsize(left_path), encoding))
+		right_header = next(read_rows_between(f_right, 0, right_blocks[0][0] if right_blocks else os.path.getsize(right_path), encoding))
+		left_match_indexes = [ left_header.index(k) for k in match_keys ]
+		right_match_indexes = [ right_header.index(k) for k in match_keys ]
+		left_check_equal_indexes = [ left_header.index(k) for k in check_equal_keys ]
+		right_check_equal_indexes = [ right_header.index(k) for k in check_equal_keys ]
+
+		for left_first, left_stop, right_first, right_stop in zip(left_boundaries[:-1], left_boundaries[1:], right_boundaries[:-1], right_boundaries[1:]):
+			left_segment = left_blocks[left_first:left_stop]
+			right_segment = right_blocks[right_first:right_stop]
+			if len(left_segment) == 1 and len(right_segment) == 1 and left_segment[0][4] == right_segment[0][4] and not differences.report_each_equal:
+				row_count = left_segment[0][2]
+				differences.left_row_count += row_count
+				differences.right_row_count += row_count
+				differences.matched_rows_equal += row_count
+				continue
+
+			left_rows = read_rows_between(f_left, left_segment[0][0], left_segment[-1][1], encoding) if left_segment else iter(())
+			right_rows = read_rows_between(f_right, right_segment[0][0], right_segment[-1][1], encoding) if right_segment else iter(())
+			if not compare_sorted_rows(left_rows, right_rows, left_match_indexes, right_match_indexes, left_check_equal_indexes, right_check_equal_indexes, differences, to_the_end=True):
+				break
+
+	differences.print_counts()
+	return differences.results()
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(description='Prints rows from one CSV file matched to rows another CSV file on the basis of some columns if those rows are not equal in other columns.')
 	parser.add_argument('--match-column', action='append', dest='match_keys', help='A column to match rows upon. Rows are matched if all of their values for all match columns are equal. This flag can be used multiple times to match on multiple columns.')
 	parser.add_argument('--check-column', action='append', dest='check_equal_keys', help="A column to check for equality between matched rows. A check fails if the two matched rows' values for a checked column are not equal. This flag can be used multiple times to check multiple columns.")
-	parser.add_argument('--assume-sorted', action='store_true', default=False, help='Assume that both tables are sorted by all of the match columns in order. [NOTE: Currently required. Use sort(1) and possibly csv_permute to put both tables into sorted order.]')
+	parser.add_argument('--assume-sorted', action='store_true', default=False, help='Assume that both tables are sorted by all of the match columns in order, and compare them by merging them, holding only one row of each in memory. Without this option, the right table is loaded into a hash table (of the match values and a digest of the checked values of each row) and the left table is compared against it; rows missing from the left table are then reported last.')
+	parser.add_argument('--memory-budget', type=parse_byte_count, default=None, help='Approximate amount of memory for the hash table of the right table when comparing unsorted tables, in bytes, optionally followed by K, M, G, or T. If the right table needs more than that, both tables are split into partitions by match values in temporary files on disk, and each pair of partitions is compared separately. Defaults to no limit.')
+	parser.add_argument('--digest-blocks', action='store_true', default=False, help='With --assume-sorted, divide each table into blocks at keys chosen by their hash, and digest the match and checked values in each block; then compare rows only within ranges of keys whose blocks differ between the tables. The digests are saved next to each table (as TABLE.csvdigests) and reused as long as the table and options are the same, so comparing a table that has barely changed against the same other table again mostly needs only the digests. Unlike a plain sorted comparison, rows at the end of either table that are missing from the other are reported.')
+	parser.add_argument('--digest-block-rows', type=int, default=1024, help='Average number of rows per block for --digest-blocks (rounded to a power of 2). Defaults to 1024.')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Split both tables into this many partitions by a hash of their match values, and compare the partitions in this many worker processes, each with its share of --memory-budget. The workers also do the splitting, a range of each table at a time. Reports are printed one partition at a time, and counts are added up across partitions. With --assume-sorted, rows at the end of either table that the other lacks are reported. --max-differences applies to each partition separately. Not used with --digest-blocks.')
 	parser.add_argument('--max-differences', type=int, default=10, help='Bail out if more than this many differences are detected. Defaults to 10. Set to 0 for unlimited differences.')
 	parser.add_argument('--reports', default='missing_left,missing_right,each_unequal', help='Configure the output. Comma-separated list of: each_missing_left, each_missing_right, each_unequal, each_equal, count_missing_left, count_missing_right, count_left, count_right, count_unequal, count_equal')
 	parser.add_argument('left_path', type=pathlib.Path, help='Path to a CSV file containing the table that will be considered to be on the left.')
 	parser.add_argument('right_path', type=pathlib.Path, help='Path to a CSV file containing the table that will be considered to be on the right.')
 	opts = parser.parse_args()
-	if not opts.assume_sorted:
-		sys.exit("Comparing unsorted tables is not yet implemented. Sort both tables, then use --assume-sorted.")
-
 	report_names = [ name.strip() for name in opts.reports.split(',') ]
 
-	left_missing_entries, right_missing_entries, matched_rows_unequal = compare_tables_sorted(opts.left_path, opts.right_path, csv.writer(sys.stdout), opts.match_keys, opts.check_equal_keys, report_names=report_names, max_differences=opts.max_differences or None)
+	if opts.digest_blocks and not opts.assume_sorted:
+		sys.exit('--digest-blocks requires --assume-sorted')
+
+	if opts.digest_blocks:
+		block_bits = max(0, round(math.log2(max(1, opts.digest_block_rows))))
+		left_missing_entries, right_missing_entries, matched_rows_unequal = compare_tables_by_blocks(opts.left_path, opts.right_path, csv.writer(sys.stdout), opts.match_keys, opts.check_equal_keys, report_names=report_names, max_differences=opts.max_differences or None, block_bits=block_bits)
+	elif opts.jobs > 1:
+		left_missing_entries, right_missing_entries, matched_rows_unequal = compare_tables_parallel(opts.left_path, opts.right_path, csv.writer(sys.stdout), opts.match_keys, opts.check_equal_keys, report_names=report_names, max_differences=opts.max_differences or None, assume_sorted=opts.assume_sorted, memory_budget=opts.memory_budget, jobs=opts.jobs)
+	elif opts.assume_sorted:
+		left_missing_entries, right_missing_entries, matched_rows_unequal = compare_tables_sorted(opts.left_path, opts.right_path, csv.writer(sys.stdout), opts.match_keys, opts.check_equal_keys, report_names=report_names, max_differences=opts.max_differences or None)
+	else:
+		left_missing_entries, right_missing_entries, matched_rows_unequal = compare_tables_hashed(opts.left_path, opts.right_path, csv.writer(sys.stdout), opts.match_keys, opts.check_equal_keys, report_names=report_names, max_differences=opts.max_differences or None, memory_budget=opts.memory_budget)
 
 	exit_status = (
 		0
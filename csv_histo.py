@@ -6,10 +6,20 @@ import pathlib
 import argparse
 import csv
 import collections
+import heapq
+import hashlib
+import math
+import json
+import zlib
+import io
+import multiprocessing
 import locale
 
 locale.setlocale(locale.LC_ALL, '')
 
+min_hll_precision = 4
+max_hll_precision = 18
+
 def get_from_indexes(orig_row, indexes):
 	permuted_row = [ orig_row[i] for i in indexes ]
 	return permuted_row
@@ -22,9 +32,158 @@ def has_nonempty_values(seq):
 	else:
 		return False
 
-def histogram(reader: csv.reader, orig_header: list, writer: csv.writer, opts: argparse.Namespace):
-	num_all = 0
+class SpaceSaving:
+	"""Approximate counter for the most frequent items of a stream (the Space-Saving algorithm of Metwally, Agrawal, and El Abbadi), using a fixed number of counters.
+
+	Every item that occurs more than total/capacity times is kept, and no count is more than max_overcount() higher than the item's true count. Two summaries can be merged (see update)."""
+	def __init__(self, capacity: int):
+		self.capacity = capacity
+		self.total = 0
+		# item -> [count, overcount]
+		self.counters = {}
+		# One (count, item) entry per counter. Counts only go up, so an entry whose count is out of date is too low, and is refreshed when it reaches the top of the heap.
+		self.heap = []
+
+	def min_counter(self):
+		"Return the (count, item) of the lowest counter, which is at the top of the heap after this."
+		heap = self.heap
+		while True:
+			count, item = heap[0]
+			current_count = self.counters[item][0]
+			if current_count == count:
+				return count, item
+			heapq.heapreplace(heap, (current_count, item))
+
+	def add(self, item, count: int=1, overcount: int=0):
+		self.total += count
+		counter = self.counters.get(item)
+		if counter is not None:
+			counter[0] += count
+			counter[1] += overcount
+		elif len(self.counters) < self.capacity:
+			self.counters[item] = [count, overcount]
+			heapq.heappush(self.heap, (count, item))
+		else:
+			# Replace the lowest counter. The new item may have occurred up to that many times before, uncounted.
+			min_count, min_item = self.min_counter()
+			del self.counters[min_item]
+			self.counters[item] = [min_count + count, min_count + overcount]
+			heapq.heapreplace(self.heap, (min_count + count, item))
+
+	def max_overcount(self):
+		"Return the most that any count can exceed the true count by."
+		if len(self.counters) < self.capacity:
+			return max((overcount for count, overcount in self.counters.values()), default=0)
+		return self.min_counter()[0]
+
+	def __len__(self):
+		return len(self.counters)
+
+	def items(self):
+		"Yield (item, count) for every item with a counter. Counts are upper bounds."
+		for item, (count, overcount) in self.counters.items():
+			yield item, count
+
+	@classmethod
+	def from_counts(cls, counts: dict):
+		"Return a summary of exact counts, with room for one more counter so that it is not full and nothing is missing from it."
+		self = cls(len(counts) + 1)
+		self.total = sum(counts.values())
+		self.counters = { item: [count, 0] for item, count in counts.items() }
+		self.heap = [ (count, item) for item, count in counts.items() ]
+		heapq.heapify(self.heap)
+		return self
+
+	def update(self, other):
+		"Merge another summary into this one, as if this one had also counted everything the other one did."
+		# An item that one summary has no counter for may have occurred as many times as its lowest counter, if it is full.
+		self_floor = self.max_overcount() if len(self.counters) >= self.capacity else 0
+		other_floor = other.max_overcount() if len(other.counters) >= other.capacity else 0
+		merged = {}
+		for item, (count, overcount) in self.counters.items():
+			other_count, other_overcount = other.counters.get(item, (other_floor, other_floor))
+			merged[item] = [count + other_count, overcount + other_overcount]
+		for item, (count, overcount) in other.counters.items():
+			if item not in merged:
+				merged[item] = [count + self_floor, overcount + self_floor]
+
+		kept = heapq.nlargest(self.capacity, merged.items(), key=lambda pair: pair[1][0])
+		self.total += other.total
+		self.counters = dict(kept)
+		self.heap = [ (count, item) for item, (count, overcount) in kept ]
+		heapq.heapify(self.heap)
+
+class HyperLogLog:
+	"""Estimator of the number of distinct items in a stream (the HyperLogLog algorithm of Flajolet et al.), using 2**precision one-byte registers. The standard error of the estimate is about 1.04/sqrt(2**precision).
+
+	Two estimators with the same precision can be merged (see update), and the registers can be saved to and loaded from a file."""
+	file_magic = b'HLL1'
+
+	def __init__(self, precision: int=14):
+		if not min_hll_precision <= precision <= max_hll_precision:
+			raise ValueError('HyperLogLog precision must be from {} to {}'.format(min_hll_precision, max_hll_precision))
+		self.precision = precision
+		self.registers = bytearray(1 << precision)
+
+	def add(self, item):
+		hash_value = int.from_bytes(hashlib.blake2b(repr(item).encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+		remaining_bits = 64 - self.precision
+		index = hash_value >> remaining_bits
+		# The position of the first 1 bit in the rest of the hash.
+		rank = remaining_bits - (hash_value & ((1 << remaining_bits) - 1)).bit_length() + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def update(self, other):
+		"Merge another estimator into this one, as if this one had also seen everything the other one did."
+		if other.precision != self.precision:
+			raise ValueError('Cannot merge HyperLogLog registers with precision {} into registers with precision {}'.format(other.precision, self.precision))
+		self.registers = bytearray(map(max, self.registers, other.registers))
+
+	def estimate(self):
+		num_registers = len(self.registers)
+		alpha = { 16: 0.673, 32: 0.697, 64: 0.709 }.get(num_registers, 0.7213 / (1 + 1.079 / num_registers))
+		raw_estimate = alpha * num_registers * num_registers / math.fsum(2.0 ** -rank for rank in self.registers)
+		num_zeros = self.registers.count(0)
+		if raw_estimate <= 2.5 * num_registers and num_zeros:
+			# Few items: count empty registers instead (linear counting).
+			return num_registers * math.log(num_registers / num_zeros)
+		return raw_estimate
 
+	def standard_error(self):
+		return 1.04 / math.sqrt(len(self.registers))
+
+	def save(self, path: pathlib.Path):
+		with open(path, 'wb') as f:
+			f.write(self.file_magic + bytes([ self.precision ]) + self.registers)
+
+	@classmethod
+	def load(cls, path: pathlib.Path):
+		with open(path, 'rb') as f:
+			data = f.read()
+		if data[:len(cls.file_magic)] != cls.file_magic:
+			raise ValueError('{} is not a HyperLogLog registers file'.format(path))
+		precision = data[len(cls.file_magic)]
+		self = cls(precision)
+		registers = data[len(cls.file_magic) + 1:]
+		if len(registers) != len(self.registers):
+			raise ValueError('{} is truncated'.format(path))
+		self.registers = bytearray(registers)
+		return self
+
+def merged_registers(hll: HyperLogLog, opts: argparse.Namespace):
+	"Merge the registers files named by --load-registers into hll, and save the result if --save-registers was given."
+	for path in opts.load_registers:
+		try:
+			hll.update(HyperLogLog.load(path))
+		except ValueError as exc:
+			sys.exit('{}: {}'.format(path, exc))
+	if opts.save_registers:
+		hll.save(opts.save_registers)
+	return hll
+
+def selected_indexes(orig_header: list, opts: argparse.Namespace):
+	"Return the indexes of the columns named by --only-columns, or None to examine all columns."
 	columns_of_interest = opts.only_columns
 	if columns_of_interest:
 		# TODO: Use csv.reader to parse this
@@ -39,13 +198,102 @@ def histogram(reader: csv.reader, orig_header: list, writer: csv.writer, opts: a
 				indexes.append(idx)
 	else:
 		indexes = None
+	return indexes
 
-	counter = collections.Counter()
+def selected_header(orig_header: list, opts: argparse.Namespace):
+	"Return the names of the columns of interest."
+	indexes = selected_indexes(orig_header, opts)
+	return orig_header if not opts.only_columns else get_from_indexes(orig_header, indexes)
 
+def estimate_distinct(reader: csv.reader, orig_header: list, opts: argparse.Namespace):
+	"Estimate the number of unique combinations of values from the columns of interest, without counting them. Returns the HyperLogLog estimator and the number of rows read."
+	num_all = 0
+	indexes = selected_indexes(orig_header, opts)
+	hll = HyperLogLog(opts.hll_precision)
 	for orig_row in reader:
-		selected_values = tuple(orig_row if not indexes else get_from_indexes(orig_row, indexes))
-		counter[selected_values] += 1
+		hll.add(tuple(orig_row if not indexes else get_from_indexes(orig_row, indexes)))
 		num_all += 1
+	return hll, num_all
+
+def new_counter(opts: argparse.Namespace):
+	if opts.heavy_hitters:
+		return SpaceSaving(opts.heavy_hitters)
+	else:
+		return collections.Counter()
+
+def count_combinations(reader: csv.reader, orig_header: list, opts: argparse.Namespace):
+	"Count the unique combinations of values from the columns of interest. Returns the counter (a Counter or, with --heavy-hitters, a SpaceSaving) and the number of rows read."
+	num_all = 0
+
+	indexes = selected_indexes(orig_header, opts)
+
+	counter = new_counter(opts)
+	if opts.heavy_hitters:
+		for orig_row in reader:
+			selected_values = tuple(orig_row if not indexes else get_from_indexes(orig_row, indexes))
+			counter.add(selected_values)
+			num_all += 1
+	else:
+		for orig_row in reader:
+			selected_values = tuple(orig_row if not indexes else get_from_indexes(orig_row, indexes))
+			counter[selected_values] += 1
+			num_all += 1
+
+	return counter, num_all
+
+state_file_magic = b'CSVHISTO1\n'
+
+def save_state(path: pathlib.Path, header: list, counter):
+	"Save the counts in counter (a Counter or SpaceSaving), of combinations of the columns in header, to a compressed file at path."
+	state = { 'columns': header }
+	if isinstance(counter, SpaceSaving):
+		state['capacity'] = counter.capacity
+		state['total'] = counter.total
+		state['counters'] = [ [ count, overcount ] + list(item) for item, (count, overcount) in counter.counters.items() ]
+	else:
+		state['counts'] = [ [ count ] + list(item) for item, count in counter.items() ]
+	data = json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8', 'surrogatepass')
+	with open(path, 'wb') as f:
+		f.write(state_file_magic)
+		f.write(zlib.compress(data))
+
+def load_state(path: pathlib.Path):
+	"Load counts saved by save_state. Returns the header of the counted columns, the counter, and the number of rows counted. Raises ValueError if the file is not a saved state."
+	with open(path, 'rb') as f:
+		data = f.read()
+	if not data.startswith(state_file_magic):
+		raise ValueError('not a csv_histo state file')
+	try:
+		state = json.loads(zlib.decompress(data[len(state_file_magic):]).decode('utf-8', 'surrogatepass'))
+	except (zlib.error, UnicodeDecodeError, json.JSONDecodeError) as exc:
+		raise ValueError('damaged csv_histo state file ({})'.format(exc))
+
+	if 'counters' in state:
+		counter = SpaceSaving(state['capacity'])
+		counter.total = state['total']
+		counter.counters = { tuple(entry[2:]): entry[:2] for entry in state['counters'] }
+		counter.heap = [ (count, item) for item, (count, overcount) in counter.counters.items() ]
+		heapq.heapify(counter.heap)
+		num_all = counter.total
+	else:
+		counter = collections.Counter({ tuple(entry[1:]): entry[0] for entry in state['counts'] })
+		num_all = sum(counter.values())
+	return state['columns'], counter, num_all
+
+def merge_counters(counter, other):
+	"Add the counts in other into counter. Exact counts can be merged into approximate counts (from --heavy-hitters), but not the other way around. Also merges HyperLogLog estimators."
+	if isinstance(counter, SpaceSaving):
+		if not isinstance(other, SpaceSaving):
+			other = SpaceSaving.from_counts(other)
+		counter.update(other)
+	elif isinstance(other, SpaceSaving):
+		raise ValueError('approximate counts (from --heavy-hitters) cannot be merged into exact counts')
+	else:
+		counter.update(other)
+
+def histogram(counter, header: list, writer: csv.writer, opts: argparse.Namespace):
+	"Write the counts of combinations of values from the columns in header, filtered by --min-count and --max-count, from most to least common. Returns the number of combinations and rows written, and the maximum overcount of approximate counts (or None)."
+	max_overcount = counter.max_overcount() if isinstance(counter, SpaceSaving) else None
 
 	pairs = [
 		(count, selected_values)
@@ -56,15 +304,160 @@ def histogram(reader: csv.reader, orig_header: list, writer: csv.writer, opts: a
 	pairs.sort()
 
 	num_matched = 0
-	new_header = [ 'count' ] * opts.show_count + (orig_header if not columns_of_interest else get_from_indexes(orig_header, indexes))
+	new_header = [ 'count' ] * opts.show_count + header
 	writer.writerow(new_header)
 	for count, selected_values in reversed(pairs):
 		writer.writerow([ count ] * opts.show_count + list(selected_values))
 		num_matched += count
 
 	num_combos = len(pairs)
-	num_rows = len(counter)
-	return num_combos, num_matched, num_all
+	return num_combos, num_matched, max_overcount
+
+def print_counts(num_combos: int, num_matched: int, max_overcount: int, num_all: int):
+	print('{}\t{:n}'.format('unique combinations', num_combos), file=sys.stderr)
+	print('{}\t{:n}'.format('rows counted', num_matched), file=sys.stderr)
+	print('{}\t{:n}'.format('all rows', num_all), file=sys.stderr)
+	if max_overcount is not None:
+		print('{}\t{:n}'.format('maximum overcount', max_overcount), file=sys.stderr)
+
+def print_estimate(hll: HyperLogLog, num_all: int):
+	print('{}\t{:n}'.format('estimated unique combinations', round(hll.estimate())), file=sys.stderr)
+	print('{}\t{:.2%}'.format('standard error', hll.standard_error()), file=sys.stderr)
+	print('{}\t{:n}'.format('all rows', num_all), file=sys.stderr)
+
+def count_reader(reader: csv.reader, orig_header: list, opts: argparse.Namespace):
+	"Count the combinations of values in the rows from reader (or, with --estimate-distinct, estimate how many there are). Returns the counter or HyperLogLog estimator, and the number of rows read."
+	if opts.estimate_distinct:
+		return estimate_distinct(reader, orig_header, opts)
+	else:
+		return count_combinations(reader, orig_header, opts)
+
+# Copied from csv_select
+# Size of the byte ranges that --jobs divides the input into. Each range is read whole by one worker process.
+parallel_chunk_size = 32 * 1024 * 1024
+
+def find_header_end(path: pathlib.Path):
+	"Return the byte offset just past the header record of the file at path."
+	offset = 0
+	quote_count = 0
+	with open(path, 'rb') as f:
+		for line in f:
+			offset += len(line)
+			quote_count += line.count(b'"')
+			if quote_count % 2 == 0:
+				break
+	return offset
+
+def scan_for_record_starts(path: pathlib.Path, start: int, end: int):
+	"""Count the quote characters in the given byte range of the file at path, and find where records could start within that range.
+
+	Any line break that follows an even number of quotes (counting from the start of the file) ends a record; any line break within a quoted field follows an odd number. Since the quotes before this range haven't been counted yet, return (quote_count, even_start, odd_start): the number of quotes in the range, the offset just past the first line break after an even number of quotes counted from start, and likewise for an odd number. Either offset is None if there is no such line break in the range.
+	This assumes quotes appear only around quoted fields, as csv.writer writes them."""
+	with open(path, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+
+	starts = [ None, None ]
+	quote_count = 0
+	scanned = 0
+	line_end = data.find(b'\n')
+	while line_end >= 0:
+		quote_count += data.count(b'"', scanned, line_end)
+		scanned = line_end
+		parity = quote_count % 2
+		if starts[parity] is None:
+			starts[parity] = start + line_end + 1
+			if None not in starts:
+				break
+		# The parity can't change until the next quote, so skip to the first line break after it.
+		next_quote = data.find(b'"', line_end)
+		if next_quote < 0:
+			break
+		line_end = data.find(b'\n', next_quote)
+
+	return data.count(b'"'), starts[0], starts[1]
+
+def record_aligned_ranges(path: pathlib.Path, start: int, pool):
+	"Divide the file at path, from start (which must be the start of a record) to the end, into byte ranges of roughly parallel_chunk_size that each begin and end on a record boundary. Uses pool to scan the file in parallel. Returns a list of (start, end) pairs."
+	size = os.path.getsize(path)
+	range_starts = list(range(start, size, parallel_chunk_size))
+	scans = pool.starmap(scan_for_record_starts, [ (path, range_start, min(range_start + parallel_chunk_size, size)) for range_start in range_starts ])
+
+	boundaries = [ start ]
+	quotes_before = 0
+	for i, (quote_count, even_start, odd_start) in enumerate(scans):
+		if i > 0:
+			record_start = even_start if quotes_before % 2 == 0 else odd_start
+			if record_start is not None and record_start < size:
+				boundaries.append(record_start)
+		quotes_before += quote_count
+	boundaries.append(size)
+
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+def count_chunk(job: tuple):
+	"Worker function for --jobs. job is (path, orig_header, start, end, opts). Count the records in a byte range of an input file. Returns the same as count_reader."
+	path, orig_header, start, end, opts = job
+	with open(path, 'rb') as f:
+		f.seek(start)
+		reader = csv.reader(io.TextIOWrapper(io.BytesIO(f.read(end - start)), encoding=opts.input_encoding))
+		return count_reader(reader, orig_header, opts)
+
+def counted_parts(opts: argparse.Namespace):
+	"Count each input file (or, with --jobs, each record-aligned chunk of each input file), and load each saved state. Yields (path, header, counter, num_all) for each, where header is the names of the counted columns."
+	if not (opts.input_paths or opts.load_state):
+		reader = csv.reader(sys.stdin)
+		orig_header = next(reader)
+		yield ('stdin', selected_header(orig_header, opts)) + count_reader(reader, orig_header, opts)
+
+	if opts.jobs > 1 and opts.input_paths:
+		with multiprocessing.Pool(opts.jobs) as pool:
+			for path in opts.input_paths:
+				with open(path, 'r', encoding=opts.input_encoding) as f:
+					reader = csv.reader(f)
+					orig_header = next(reader)
+					header = selected_header(orig_header, opts)
+					if not os.path.isfile(path):
+						# Can't be divided into chunks, so count it here.
+						yield (path, header) + count_reader(reader, orig_header, opts)
+						continue
+				jobs = [ (path, orig_header, start, end, opts) for start, end in record_aligned_ranges(path, find_header_end(path), pool) ]
+				for counts, num_all in pool.imap(count_chunk, jobs):
+					yield path, header, counts, num_all
+	else:
+		for path in opts.input_paths:
+			with open(path, 'r', encoding=opts.input_encoding) as f:
+				reader = csv.reader(f)
+				orig_header = next(reader)
+				yield (path, selected_header(orig_header, opts)) + count_reader(reader, orig_header, opts)
+
+	for path in opts.load_state:
+		try:
+			yield (path,) + load_state(path)
+		except ValueError as exc:
+			sys.exit('{}: {}'.format(path, exc))
+
+def count_rows(writer: csv.writer, opts: argparse.Namespace):
+	"Count all of the inputs, merging their counts, and write the histogram (or, with --estimate-distinct, print the estimate)."
+	counts = HyperLogLog(opts.hll_precision) if opts.estimate_distinct else new_counter(opts)
+	header = None
+	num_all = 0
+	for path, part_header, part_counts, part_num_all in counted_parts(opts):
+		try:
+			if header is not None and part_header != header:
+				raise ValueError('counts are of columns {} rather than {}'.format(part_header, header))
+			merge_counters(counts, part_counts)
+		except ValueError as exc:
+			sys.exit('{}: {}'.format(path, exc))
+		header = part_header
+		num_all += part_num_all
+
+	if opts.estimate_distinct:
+		print_estimate(merged_registers(counts, opts), num_all)
+	else:
+		if opts.save_state:
+			save_state(opts.save_state, header, counts)
+		print_counts(*histogram(counts, header, writer, opts), num_all)
 
 def main():
 	parser = argparse.ArgumentParser()
@@ -74,29 +467,30 @@ def main():
 	parser.add_argument('--hide-count', '--no-show-count', dest='show_count', action='store_false', help='Only output value combinations counted, not their counts.')
 	parser.add_argument('--min-count', default=0, type=int, help="Only report combinations that appear at least this many times.")
 	parser.add_argument('--max-count', default=None, type=int, help="Only report combinations that appear no more than this many times.")
-	parser.add_argument('input_path', nargs='?', default=None, type=pathlib.Path, help="Path to a file containing CSV data to count value groups from.")
+	parser.add_argument('--heavy-hitters', metavar='COUNTERS', default=None, type=int, help="Count approximately in a fixed amount of memory, keeping only this many counters (Space-Saving). Every combination that makes up more than 1/COUNTERS of all rows is reported, but counts may be too high, by up to the 'maximum overcount' printed at the end, and combinations below that count may be missing or included by mistake. --min-count and --max-count apply to the approximate counts.")
+	parser.add_argument('--estimate-distinct', action='store_true', default=False, help="Don't count combinations; only estimate how many unique combinations there are, using a HyperLogLog estimator of fixed size (see --hll-precision). Nothing is written to stdout; the estimate is printed with the other stats on stderr.")
+	parser.add_argument('--hll-precision', metavar='BITS', default=14, type=int, help="With --estimate-distinct, use 2**BITS registers of one byte each (from {} to {}). More registers give a smaller standard error, about 1.04/sqrt(2**BITS): the default of 14 uses 16 KiB for about 0.8%%.".format(min_hll_precision, max_hll_precision))
+	parser.add_argument('--save-registers', metavar='PATH', default=None, type=pathlib.Path, help="With --estimate-distinct, save the HyperLogLog registers to this file, to merge with others later using --load-registers.")
+	parser.add_argument('--load-registers', metavar='PATH', action='append', default=[], type=pathlib.Path, help="With --estimate-distinct, merge HyperLogLog registers saved by an earlier run (of csv_histo or csv_alphabet, with the same --hll-precision and columns) into the estimate. Can be used more than once.")
+	parser.add_argument('--save-state', metavar='PATH', default=None, type=pathlib.Path, help="Save all of the counts (including any loaded with --load-state, and before --min-count and --max-count) to this file, to merge into a later run using --load-state.")
+	parser.add_argument('--load-state', metavar='PATH', action='append', default=[], type=pathlib.Path, help="Add counts saved by an earlier run with --save-state, of the same columns, into this run's counts. Can be used more than once. If no input paths are given, stdin is not read; only the saved counts are merged. Exact counts can be merged into a --heavy-hitters run, but approximate counts can only be merged into one.")
+	parser.add_argument('-j', '--jobs', type=int, default=1, help="Divide the input files into chunks and count the chunks in this many worker processes, then merge the counts before filtering and sorting them. Each worker counts every combination in its chunk, so memory use can grow with the number of jobs (except with --heavy-hitters or --estimate-distinct).")
+	parser.add_argument('input_paths', nargs='*', type=pathlib.Path, help="Paths to files containing CSV data to count value groups from. The counts of all of the files are added together; the columns of interest must be the same in all of them. If there are none (and no --load-state), reads from stdin.")
 	opts = parser.parse_args()
+	if opts.heavy_hitters is not None and opts.heavy_hitters < 1:
+		parser.error('--heavy-hitters needs at least one counter')
+	if opts.jobs < 1:
+		parser.error('--jobs must be at least 1')
+	if opts.estimate_distinct and opts.heavy_hitters:
+		parser.error('--estimate-distinct and --heavy-hitters cannot be used together')
+	if not min_hll_precision <= opts.hll_precision <= max_hll_precision:
+		parser.error('--hll-precision must be from {} to {}'.format(min_hll_precision, max_hll_precision))
+	if opts.estimate_distinct and (opts.save_state or opts.load_state):
+		parser.error('--estimate-distinct does not use --save-state or --load-state (see --save-registers and --load-registers)')
 
 	writer = csv.writer(sys.stdout)
 
-	path = opts.input_path
-	if path:
-		with open(path, 'r', encoding=opts.input_encoding) as f:
-			reader = csv.reader(f)
-			header = next(reader)
-
-			num_combos, num_matched, num_all = histogram(reader, header, writer, opts)
-			print('{}\t{:n}'.format('unique combinations', num_combos), file=sys.stderr)
-			print('{}\t{:n}'.format('rows counted', num_matched), file=sys.stderr)
-			print('{}\t{:n}'.format('all rows', num_all), file=sys.stderr)
-	else:
-		reader = csv.reader(sys.stdin)
-		header = next(reader)
-
-		num_combos, num_matched, num_all = histogram(reader, header, writer, opts)
-		print('{}\t{:n}'.format('unique combinations', num_combos), file=sys.stderr)
-		print('{}\t{:n}'.format('rows counted', num_matched), file=sys.stderr)
-		print('{}\t{:n}'.format('all rows', num_all), file=sys.stderr)
+	count_rows(writer, opts)
 
 if __name__ == "__main__":
 	main()
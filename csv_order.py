@@ -4,8 +4,19 @@ import sys
 import os
 import pathlib
 import argparse
+import contextlib
 import csv
+import heapq
+import io
+import itertools
 import locale
+import math
+import mmap
+import multiprocessing
+import operator
+import pickle
+import re
+import tempfile
 
 locale.setlocale(locale.LC_ALL, '')
 
@@ -21,31 +32,218 @@ def has_nonempty_values(seq):
 	else:
 		return False
 
-class ReversedComparable:
-	def __init__(self, obj):
-		self.obj = obj
-	def __lt__(self, other):
-		return self.obj >= other.obj
-	def __le__(self, other):
-		return self.obj > other.obj
-	def __gt__(self, other):
-		return self.obj <= other.obj
-	def __ge__(self, other):
-		return self.obj < other.obj
-	def __cmp__(self, other):
-		return -cmp(self.obj, other.obj)
+# Sort keys are built from natively comparable values (strings, bytes, numbers, and tuples of them), so that sorting never calls back into Python code. A descending key is encoded so that ascending order of the keys is descending order of the values. In either direction, an empty value (or, for dates, a value that isn't a date) sorts as less than any other value: first when ascending, last when descending.
+
+# Maps each byte of a UTF-8 string to its inverse. 0xFF never appears in UTF-8, so it's left free to terminate inverted strings.
+inverted_bytes = bytes(0xFE - b for b in range(0xFF)) + b'\xFF'
+
+def descending_str_key(value_str: str):
+	"Invert the UTF-8 bytes of a string, and end them with a byte greater than any inverted byte, so that the string sorts after any longer string it's a prefix of."
+	return value_str.encode('utf-8', 'surrogatepass').translate(inverted_bytes) + b'\xFF'
+
+def int_key(value_str: str):
+	return int(value_str) if value_str else -math.inf
+
+def descending_int_key(value_str: str):
+	return -int(value_str) if value_str else math.inf
+
+# NaN isn't less than, greater than, or equal to anything, so sorting with it as a key would leave the rows in an order that depends on where the NaNs happened to be (which differs between sorting in memory, on disk, and in parallel). So float keys are tuples that put NaN after every number: last when ascending, first when descending.
+
+def float_key(value_str: str):
+	if not value_str:
+		return (0, -math.inf)
+	value = float(value_str)
+	return (1, 0.0) if value != value else (0, value)
+
+def descending_float_key(value_str: str):
+	if not value_str:
+		return (1, math.inf)
+	value = float(value_str)
+	return (0, 0.0) if value != value else (1, -value)
+
+# Copied from csv_select
+ymd_exp = re.compile('(?P<YEAR>[0-9]+)(?:-(?P<MONTH>[0-9]+)(?:-(?P<DAY>[0-9]+))?)?')
+
+def date_key(value_str: str):
+	"Return a date as a tuple of its year, month, and day, with 0 for the month or day if it doesn't have one, or an empty tuple if it isn't a date."
+	match = ymd_exp.match(value_str)
+	if not match:
+		return ()
+	return tuple(int(x) if x is not None else 0 for x in match.groups())
+
+def descending_date_key(value_str: str):
+	key = date_key(value_str)
+	if not key:
+		return (math.inf,)
+	return tuple(-x for x in key)
+
+sort_key_functions = {
+	('str', False): str,
+	('str', True): descending_str_key,
+	('int', False): int_key,
+	('int', True): descending_int_key,
+	('float', False): float_key,
+	('float', True): descending_float_key,
+	('date', False): date_key,
+	('date', True): descending_date_key,
+}
+value_types = sorted(set(value_type for value_type, reverse in sort_key_functions))
+directions = { 'asc': False, 'desc': True }
 
 class SortColumn:
-	def __init__(self, name, reverse=False, value_type=str):
+	def __init__(self, name, reverse=False, value_type='str'):
 		self.name = name
 		self.reverse = reverse
 		self.value_type = value_type
-		assert callable(self.value_type)
-	def parse_value(self, value_str):
-		value = self.value_type(value_str)
-		if self.reverse:
-			value = ReversedComparable(value)
-		return value
+		self.parse_value = sort_key_functions[value_type, reverse]
+
+	@classmethod
+	def parse(cls, spec: str):
+		"Parse a column spec of the form name[:type][:asc|desc]."
+		parts = spec.split(':')
+		reverse = False
+		value_type = 'str'
+		# Anything before the type and direction (including any colons) is the name.
+		if len(parts) > 1 and parts[-1] in directions:
+			reverse = directions[parts.pop()]
+		if len(parts) > 1 and parts[-1] in value_types:
+			value_type = parts.pop()
+		return cls(':'.join(parts), reverse, value_type)
+
+# Copied from csv_select
+def parse_byte_count(count_str: str):
+	"Parse a number of bytes, optionally followed by K, M, G, or T (powers of 1024)."
+	multipliers = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+	count_str = count_str.strip().upper().rstrip('B')
+	multiplier = 1
+	if count_str and count_str[-1] in multipliers:
+		multiplier = multipliers[count_str[-1]]
+		count_str = count_str[:-1]
+	return int(float(count_str) * multiplier)
+
+# Approximate memory cost of one row to be sorted, not counting its values: the tuple and lists holding it.
+bytes_per_row = 200
+# Approximate memory cost of one value in a row, not counting its characters.
+bytes_per_value = 60
+
+def estimated_row_size(orig_row: list):
+	return bytes_per_row + sum(len(value) + bytes_per_value for value in orig_row)
+
+class RunSorter:
+	"""Sorts items in a bounded amount of memory.
+
+	Items are collected in memory until they add up to memory_budget bytes (as estimated by the caller). Then they're sorted and written to a temporary file as a run, and collection starts over. sorted_items merges the runs with heapq.merge, first merging them in groups into longer runs if there are too many to merge at once. Because equal items are indistinguishable, the output is exactly the same as sorting all the items at once. With no memory budget, nothing is ever written to disk.
+
+	Use it as a context manager (or call close) so that the temporary directory is removed even if sorting fails."""
+	# Largest number of items pickled together in a run file. With a memory budget, blocks are made smaller so that a merge's blocks add up to about the budget.
+	items_per_block = 1024
+	# Largest number of runs merged at once. Each one holds a file open and a block in memory.
+	max_merge_runs = 64
+
+	def __init__(self, memory_budget: int=None, temp_dir: str=None):
+		"If temp_dir is given, runs are written there (and left for the caller to clean up) instead of in a new temporary directory."
+		self.memory_budget = memory_budget
+		self.items = []
+		self.items_size = 0
+		self.temp_dir = None
+		self.run_dir = temp_dir
+		self.run_paths = []
+		self.block_length = self.items_per_block
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def add(self, item, size: int):
+		self.items.append(item)
+		self.items_size += size
+		if self.memory_budget is not None and self.items_size > self.memory_budget:
+			self.spill()
+
+	def run_directory(self):
+		"Return the directory runs are written to, creating a temporary one if needed."
+		if self.run_dir is None:
+			self.temp_dir = tempfile.TemporaryDirectory(prefix='csv_order-')
+			self.run_dir = self.temp_dir.name
+		return self.run_dir
+
+	def spill(self):
+		"Sort the items in memory and write them out as a run."
+		self.items.sort()
+		if self.memory_budget is not None and self.items:
+			average_size = self.items_size / len(self.items)
+			self.block_length = max(1, min(self.block_length, int(self.memory_budget / self.max_merge_runs / average_size)))
+		self.run_paths.append(self.write_run(self.items, self.run_directory(), self.block_length))
+		self.items = []
+		self.items_size = 0
+
+	def add_runs(self, run_paths: list, block_length: int):
+		"Add runs that were sorted and written elsewhere (such as by another RunSorter, whose block_length this is) to be merged."
+		self.run_paths.extend(run_paths)
+		self.block_length = min(self.block_length, block_length)
+
+	@classmethod
+	def write_run(cls, items, run_dir: str, block_length: int):
+		"Write items, which must already be in order, to a new run file in run_dir, and return its path."
+		# Other RunSorters, possibly in other processes, may be writing runs to the same directory.
+		run_fd, run_path = tempfile.mkstemp(prefix='run-', suffix='.pickle', dir=run_dir)
+		items = iter(items)
+		with open(run_fd, 'wb') as f:
+			while True:
+				block = list(itertools.islice(items, block_length))
+				if not block:
+					break
+				pickle.dump(block, f, pickle.HIGHEST_PROTOCOL)
+		return run_path
+
+	@classmethod
+	def merge_runs(cls, run_paths: list, run_dir: str, block_length: int):
+		"Merge some runs into one new run (removing the old ones), and return its path."
+		if len(run_paths) == 1:
+			return run_paths[0]
+		return cls.write_run(heapq.merge(*(cls.read_run(run_path) for run_path in run_paths)), run_dir, block_length)
+
+	def reduce_runs(self, map_function=map):
+		"Merge the runs in groups into longer runs until there are few enough to merge all at once. The groups are merged using map_function (such as a Pool's map, to merge them in parallel) and merge_run_group."
+		while len(self.run_paths) > self.max_merge_runs:
+			groups = [ (self.run_paths[i:i + self.max_merge_runs], self.run_directory(), self.block_length) for i in range(0, len(self.run_paths), self.max_merge_runs) ]
+			self.run_paths = list(map_function(merge_run_group, groups))
+
+	@classmethod
+	def read_run(cls, run_path: str):
+		with open(run_path, 'rb') as f:
+			while True:
+				try:
+					block = pickle.load(f)
+				except EOFError:
+					break
+				yield from block
+		os.remove(run_path)
+
+	def sorted_items(self):
+		"Yield all of the items added so far, in order."
+		if not self.run_paths:
+			self.items.sort()
+			yield from self.items
+			self.items = []
+		else:
+			# Write out what's left in memory too, so the merge only holds a block of each run.
+			if self.items:
+				self.spill()
+			self.reduce_runs()
+			run_paths, self.run_paths = self.run_paths, []
+			yield from heapq.merge(*(self.read_run(run_path) for run_path in run_paths))
+
+	def close(self):
+		if self.temp_dir is not None:
+			self.temp_dir.cleanup()
+			self.temp_dir = None
+
+def merge_run_group(job: tuple):
+	"Worker function for RunSorter.reduce_runs. job is (run_paths, run_dir, block_length). Returns the path of the merged run."
+	return RunSorter.merge_runs(*job)
 
 def validate_schema(input_path: pathlib.Path, sort_columns: list):
 	"Returns (valid, missing_columns) where valid is True if none of the indicated columns are missing from the file's header, or False if one or more columns are missing. In the latter case, missing_columns is a list of those columns."
@@ -55,48 +253,319 @@ def validate_schema(input_path: pathlib.Path, sort_columns: list):
 		missing_columns = [ col for col in sort_columns if col.name not in header ]
 		return (not missing_columns), missing_columns
 	
-def order_rows(input_path: pathlib.Path, sort_columns: list, writer: csv.writer, opts: argparse.Namespace):
-	all_row_count = 0
-	included_row_count = 0 # all_row_count minus dropped rows.
+# Copied from csv_select
+# Size of the byte ranges that --jobs divides the input into. Each range is read whole by one worker process.
+parallel_chunk_size = 32 * 1024 * 1024
+
+def find_header_end(path: pathlib.Path):
+	"Return the byte offset just past the header record of the file at path."
+	offset = 0
+	quote_count = 0
+	with open(path, 'rb') as f:
+		for line in f:
+			offset += len(line)
+			quote_count += line.count(b'"')
+			if quote_count % 2 == 0:
+				break
+	return offset
+
+def scan_for_record_starts(path: pathlib.Path, start: int, end: int):
+	"""Count the quote characters in the given byte range of the file at path, and find where records could start within that range.
+
+	Any line break that follows an even number of quotes (counting from the start of the file) ends a record; any line break within a quoted field follows an odd number. Since the quotes before this range haven't been counted yet, return (quote_count, even_start, odd_start): the number of quotes in the range, the offset just past the first line break after an even number of quotes counted from start, and likewise for an odd number. Either offset is None if there is no such line break in the range.
+	This assumes quotes appear only around quoted fields, as csv.writer writes them."""
+	with open(path, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+
+	starts = [ None, None ]
+	quote_count = 0
+	scanned = 0
+	line_end = data.find(b'\n')
+	while line_end >= 0:
+		quote_count += data.count(b'"', scanned, line_end)
+		scanned = line_end
+		parity = quote_count % 2
+		if starts[parity] is None:
+			starts[parity] = start + line_end + 1
+			if None not in starts:
+				break
+		# The parity can't change until the next quote, so skip to the first line break after it.
+		next_quote = data.find(b'"', line_end)
+		if next_quote < 0:
+			break
+		line_end = data.find(b'\n', next_quote)
+
+	return data.count(b'"'), starts[0], starts[1]
+
+def record_aligned_ranges(path: pathlib.Path, start: int, pool):
+	"Divide the file at path, from start (which must be the start of a record) to the end, into byte ranges of roughly parallel_chunk_size that each begin and end on a record boundary. Uses pool to scan the file in parallel. Returns a list of (start, end) pairs."
+	size = os.path.getsize(path)
+	range_starts = list(range(start, size, parallel_chunk_size))
+	scans = pool.starmap(scan_for_record_starts, [ (path, range_start, min(range_start + parallel_chunk_size, size)) for range_start in range_starts ])
 
+	boundaries = [ start ]
+	quotes_before = 0
+	for i, (quote_count, even_start, odd_start) in enumerate(scans):
+		if i > 0:
+			record_start = even_start if quotes_before % 2 == 0 else odd_start
+			if record_start is not None and record_start < size:
+				boundaries.append(record_start)
+		quotes_before += quote_count
+	boundaries.append(size)
+
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+# Copied from csv_select
+def iter_records_with_offsets(binary_file, encoding: str, offset: int=0):
+	"Parse CSV records from a file opened in binary mode and positioned at offset (the start of a record). Yields (offset, length, row) for each record, where offset and length locate the bytes of that record, including its line break(s)."
+	position = offset
+	def lines():
+		nonlocal position
+		for line in binary_file:
+			position += len(line)
+			if line.endswith(b'\r\n'):
+				# Translate line breaks the way a file opened in text mode would.
+				line = line[:-2] + b'\n'
+			yield line.decode(encoding)
+
+	record_start = offset
+	# csv.reader pulls lines only as it needs them, so after each record, position is the end of that record.
+	for row in csv.reader(lines()):
+		yield record_start, position - record_start, row
+		record_start = position
+
+def read_header(input_path: pathlib.Path):
+	with open(input_path, 'r') as input_file:
+		return next(csv.reader(input_file))
+
+def sortable_rows_in(reader: csv.reader, indexes_to_consider: list, sort_columns: list, opts: argparse.Namespace, row_counts: list):
+	"Yield (sort key, row) for each row from reader, except rows with an empty value for a sort column if --only-nonempty. row_counts is [included_row_count, all_row_count], which are updated as rows are read."
+	for orig_row in reader:
+		row_counts[1] += 1
+		sort_item_strs = get_from_indexes(orig_row, indexes_to_consider)
+		if opts.only_nonempty and not all(sort_item_strs):
+			continue
+		row_counts[0] += 1
+
+		sort_key = tuple(col.parse_value(value_str) for col, value_str in zip(sort_columns, sort_item_strs))
+		yield sort_key, orig_row
+
+def row_locations_in(records, file_number: int, indexes_to_consider: list, sort_columns: list, opts: argparse.Namespace, row_counts: list):
+	"Like sortable_rows_in, but for --by-offset. records yields (offset, length, row), and this yields (sort key, file number, offset, length); sorting these puts rows with equal keys in input order."
+	for offset, length, orig_row in records:
+		row_counts[1] += 1
+		sort_item_strs = get_from_indexes(orig_row, indexes_to_consider)
+		if opts.only_nonempty and not all(sort_item_strs):
+			continue
+		row_counts[0] += 1
+
+		sort_key = tuple(col.parse_value(value_str) for col, value_str in zip(sort_columns, sort_item_strs))
+		yield sort_key, file_number, offset, length
+
+def sortable_row_size(item: tuple):
+	return estimated_row_size(item[1])
+
+def row_location_size(item: tuple):
+	sort_key = item[0]
+	return bytes_per_row + sum(bytes_per_value + (0 if isinstance(value, (int, float)) else len(value)) for value in sort_key)
+
+def write_rows_at_locations(sorted_items, input_paths: list, writer: csv.writer):
+	"Write each row located by sorted_items ((sort key, file number, offset, length)), reading it from a memory map of its input file."
+	encoding = locale.getpreferredencoding(False)
+	with contextlib.ExitStack() as stack:
+		mapped_files = []
+		for input_path in input_paths:
+			input_file = stack.enter_context(open(input_path, 'rb'))
+			mapped_files.append(stack.enter_context(mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)))
+
+		for sort_key, file_number, offset, length in sorted_items:
+			record = mapped_files[file_number][offset:offset + length].decode(encoding)
+			# Translate line breaks the way a file opened in text mode would, as when the row was first read.
+			orig_row = next(csv.reader(io.StringIO(record, newline=None)))
+			writer.writerow(orig_row)
+
+# Set up in each worker process by init_sort_worker.
+worker_state = None
+
+def init_sort_worker(sort_columns: list, indexes_to_consider: list, opts: argparse.Namespace, temp_dir: str):
+	global worker_state
+	worker_state = {
+		'sort_columns': sort_columns,
+		'indexes_to_consider': indexes_to_consider,
+		'opts': opts,
+		'temp_dir': temp_dir,
+	}
+
+def sort_chunk(job: tuple):
+	"Worker function for --jobs. job is (file_number, path, start, end). Sort the records in a byte range of an input file into one or more runs in the temporary directory (more than one if the worker's share of the memory budget runs out). The runs are merged down to at most RunSorter.max_merge_runs before returning. Returns (file_number, row_counts, run_paths, block_length, top_rows). With --limit, there are no runs; instead, top_rows is a list of the first rows (up to the offset plus the limit) of the byte range, in order."
+	file_number, path, start, end = job
+	opts = worker_state['opts']
+	encoding = locale.getpreferredencoding(False)
+	row_counts = [ 0, 0 ]
+	with open(path, 'rb') as f:
+		f.seek(start)
+		if opts.by_offset:
+			records = itertools.takewhile(lambda record: record[0] < end, iter_records_with_offsets(f, encoding, start))
+			items = row_locations_in(records, file_number, worker_state['indexes_to_consider'], worker_state['sort_columns'], opts, row_counts)
+			item_size = row_location_size
+		else:
+			reader = csv.reader(io.TextIOWrapper(io.BytesIO(f.read(end - start)), encoding=encoding))
+			items = sortable_rows_in(reader, worker_state['indexes_to_consider'], worker_state['sort_columns'], opts, row_counts)
+			item_size = sortable_row_size
+
+		if opts.limit is not None:
+			return file_number, row_counts, [], None, heapq.nsmallest(opts.offset + opts.limit, items)
+
+		memory_budget = opts.memory_budget // opts.jobs if opts.memory_budget is not None else None
+		sortable_rows = RunSorter(memory_budget, temp_dir=worker_state['temp_dir'])
+		for item in items:
+			sortable_rows.add(item, item_size(item))
+		sortable_rows.spill()
+		sortable_rows.reduce_runs()
+
+	return file_number, row_counts, sortable_rows.run_paths, sortable_rows.block_length, None
+
+def sort_rows_parallel(input_paths: list, sort_columns: list, indexes_to_consider: list, sortable_rows: RunSorter, row_counts_by_file: list, opts: argparse.Namespace):
+	"Divide the input files into record-aligned byte ranges and sort them in opts.jobs worker processes, adding the sorted runs to sortable_rows (merged down to few enough for it to merge at once). With --limit, returns a list of the first rows (up to the offset plus the limit) in order instead."
+	top_rows = []
+	temp_dir = sortable_rows.run_directory()
+	with multiprocessing.Pool(opts.jobs, initializer=init_sort_worker, initargs=(sort_columns, indexes_to_consider, opts, temp_dir)) as pool:
+		jobs = []
+		for file_number, input_path in enumerate(input_paths):
+			for start, end in record_aligned_ranges(input_path, find_header_end(input_path), pool):
+				jobs.append((file_number, input_path, start, end))
+		for file_number, row_counts, run_paths, block_length, chunk_top_rows in pool.imap_unordered(sort_chunk, jobs):
+			row_counts_by_file[file_number][0] += row_counts[0]
+			row_counts_by_file[file_number][1] += row_counts[1]
+			if chunk_top_rows is not None:
+				top_rows = heapq.nsmallest(opts.offset + opts.limit, itertools.chain(top_rows, chunk_top_rows))
+			else:
+				sortable_rows.add_runs(run_paths, block_length)
+		# Every chunk makes at least one run, so a big file makes too many to merge at once; merge them down in the workers while they're still around.
+		sortable_rows.reduce_runs(pool.map)
+
+	return top_rows
+
+def limited(sorted_items, opts: argparse.Namespace):
+	"Return the items after the first opts.offset, up to opts.limit of them if there is a limit."
+	stop = opts.offset + opts.limit if opts.limit is not None else None
+	return itertools.islice(sorted_items, opts.offset, stop)
+
+def order_rows(input_paths: list, sort_columns: list, writer: csv.writer, opts: argparse.Namespace):
+	"Sort the rows of all of the input files (which must have the same header) together, and write them after the header. Returns a list of [included_row_count, all_row_count] for each file."
+	header = read_header(input_paths[0])
+	indexes_to_consider = [ header.index(col.name) for col in sort_columns ]
+	row_counts_by_file = [ [ 0, 0 ] for input_path in input_paths ]
+
+	with RunSorter(opts.memory_budget) as sortable_rows:
+		if opts.jobs > 1:
+			sorted_items = sort_rows_parallel(input_paths, sort_columns, indexes_to_consider, sortable_rows, row_counts_by_file, opts)
+		else:
+			def all_sortable_rows():
+				for file_number, (input_path, row_counts) in enumerate(zip(input_paths, row_counts_by_file)):
+					if opts.by_offset:
+						with open(input_path, 'rb') as input_file:
+							records = iter_records_with_offsets(input_file, locale.getpreferredencoding(False))
+							next(records)
+							yield from row_locations_in(records, file_number, indexes_to_consider, sort_columns, opts, row_counts)
+					else:
+						with open(input_path, 'r') as input_file:
+							reader = csv.reader(input_file)
+							next(reader)
+							yield from sortable_rows_in(reader, indexes_to_consider, sort_columns, opts, row_counts)
+
+			if opts.limit is not None:
+				# Only the rows up to the offset plus the limit can be output, so keep just that many, in a heap, instead of sorting them all.
+				sorted_items = heapq.nsmallest(opts.offset + opts.limit, all_sortable_rows())
+			else:
+				item_size = row_location_size if opts.by_offset else sortable_row_size
+				for item in all_sortable_rows():
+					sortable_rows.add(item, item_size(item))
+
+		if opts.limit is None:
+			sorted_items = sortable_rows.sorted_items()
+
+		writer.writerow(header)
+		if opts.by_offset:
+			write_rows_at_locations(limited(sorted_items, opts), input_paths, writer)
+		else:
+			for sort_key, orig_row in limited(sorted_items, opts):
+				writer.writerow(orig_row)
+
+	return row_counts_by_file
+
+def is_sorted(input_path: pathlib.Path, sort_columns: list, indexes_to_consider: list, opts: argparse.Namespace):
+	"Return True if the rows of the file are in exactly the order order_rows would put them in."
 	with open(input_path, 'r') as input_file:
 		reader = csv.reader(input_file)
-		header = next(reader)
+		next(reader)
+		previous_item = None
+		for item in sortable_rows_in(reader, indexes_to_consider, sort_columns, opts, [ 0, 0 ]):
+			if previous_item is not None and item < previous_item:
+				return False
+			previous_item = item
+	return True
+
+def checked_sort_keys(items, input_path: pathlib.Path):
+	"Yield each of items, exiting with an error if one's sort key is less than the one before it."
+	previous_sort_key = None
+	for sort_key, orig_row in items:
+		if previous_sort_key is not None and sort_key < previous_sort_key:
+			sys.exit('{} is not sorted by the sort columns: {!r} comes after a row with a greater key'.format(input_path, orig_row))
+		yield sort_key, orig_row
+		previous_sort_key = sort_key
+
+def merge_sorted_rows(input_paths: list, sort_columns: list, writer: csv.writer, opts: argparse.Namespace, verified: bool):
+	"""Write the rows of input files that are each already sorted, merged into one sorted table after the header, reading all of the files at once and holding only one row of each in memory. Returns a list of [included_row_count, all_row_count] for each file.
+
+	If verified, the files are known to be in exactly the order order_rows would put them in, and the output is the same as order_rows's. Otherwise, they're only assumed to be sorted by their keys: rows with equal keys are kept in input order, and a row whose key is less than the one before it ends the merge with an error."""
+	header = read_header(input_paths[0])
+	indexes_to_consider = [ header.index(col.name) for col in sort_columns ]
+	row_counts_by_file = [ [ 0, 0 ] for input_path in input_paths ]
+
+	with contextlib.ExitStack() as stack:
+		sorted_streams = []
+		for input_path, row_counts in zip(input_paths, row_counts_by_file):
+			reader = csv.reader(stack.enter_context(open(input_path, 'r')))
+			next(reader)
+			items = sortable_rows_in(reader, indexes_to_consider, sort_columns, opts, row_counts)
+			sorted_streams.append(items if verified else checked_sort_keys(items, input_path))
 
-		indexes_to_consider = [ header.index(col.name) for col in sort_columns ]
-		sortable_rows = []
+		writer.writerow(header)
+		for sort_key, orig_row in limited(heapq.merge(*sorted_streams, key=None if verified else operator.itemgetter(0)), opts):
+			writer.writerow(orig_row)
 
-		for orig_row in reader:
-			all_row_count += 1
-			sort_item_strs = get_from_indexes(orig_row, indexes_to_consider)
-			if opts.only_nonempty:
-				drop_this_row = False
-				for value in sort_item_strs:
-					if not value:
-						drop_this_row = True
-						break
-				if drop_this_row:
-					continue
-			included_row_count += 1
+	return row_counts_by_file
 
-			sort_items = [ col.parse_value(value_str) for col, value_str in zip(sort_columns, sort_item_strs) ]
-			sortable_rows.append((sort_items, orig_row))
+def merge_rows(input_paths: list, sort_columns: list, writer: csv.writer, opts: argparse.Namespace):
+	"Write the rows of all of the input files as one sorted table. If the files are each already sorted (as declared by --assume-sorted, or as found by checking them first), they're merged as they're read, in bounded memory; otherwise, they're all sorted together. Returns a list of [included_row_count, all_row_count] for each file."
+	if opts.assume_sorted:
+		return merge_sorted_rows(input_paths, sort_columns, writer, opts, verified=False)
 
-	sortable_rows.sort()
-	writer.writerow(header)
-	for sort_items, orig_row in sortable_rows:
-		writer.writerow(orig_row)
+	header = read_header(input_paths[0])
+	indexes_to_consider = [ header.index(col.name) for col in sort_columns ]
+	if all(is_sorted(input_path, sort_columns, indexes_to_consider, opts) for input_path in input_paths):
+		print('All input files are already sorted; merging them', file=sys.stderr)
+		return merge_sorted_rows(input_paths, sort_columns, writer, opts, verified=True)
 
-	return included_row_count, all_row_count
+	return order_rows(input_paths, sort_columns, writer, opts)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
-	parser.add_argument('--column', action='append', dest='sort_columns', help="Order by this column. Can be used multiple times to order by multiple columns.")
+	parser.add_argument('--column', action='append', dest='sort_columns', help="Order by this column. Can be used multiple times to order by multiple columns. The column name can be followed by :str (the default), :int, :float, or :date (YYYY, YYYY-MM, or YYYY-MM-DD) to compare its values as that type, and then by :asc (the default) or :desc to sort in that direction; for example, --column price:float:desc. Empty values (and values of a date column that aren't dates) sort before all others when ascending and after all others when descending.")
 	parser.add_argument('--only-nonempty', '--only-non-empty', action='store_true', default=False, help="Omit rows for which the order column is empty.")
+	parser.add_argument('--memory-budget', type=parse_byte_count, default=None, help='Approximate amount of memory to hold rows in while sorting, in bytes, optionally followed by K, M, G, or T. Whenever the rows read so far need more than that, they are sorted and moved to a temporary file on disk, and all of these runs are merged at the end. Defaults to no limit.')
+	parser.add_argument('-j', '--jobs', type=int, default=1, help='Sort each input file in this many worker processes, each of which sorts chunks of the file into runs on disk (within its share of --memory-budget, if any); the runs are then merged. The output is the same as without --jobs.')
+	parser.add_argument('--merge', action='store_true', default=False, help="Output all of the input files as one sorted table, instead of sorting each file separately. The first file's header determines the schema; any files with a different header are skipped. If every file is already sorted, they're merged as they're read, holding only one row of each in memory, instead of being sorted again.")
+	parser.add_argument('--assume-sorted', action='store_true', default=False, help="With --merge, assume that each input file is already sorted by the sort columns, and merge them without checking them first. Rows with equal sort keys are kept in input order. Exits with an error if a file turns out not to be sorted.")
+	parser.add_argument('--limit', type=int, default=None, help='Output at most this many rows of each sorted table (or of the whole output, with --merge). Only the first rows, up to the offset plus the limit, are kept as the input is read, in a heap, so memory use depends on the limit rather than the size of the input. When --merge merges files that are already sorted, it stops reading them once the limit is reached, so the row counts include only the rows read.')
+	parser.add_argument('--offset', type=int, default=0, help='Skip this many rows of each sorted table (or of the whole output, with --merge) before outputting any. Together with --limit, this can be used to output one page of rows at a time.')
+	parser.add_argument('--by-offset', action='store_true', default=False, help="While sorting, keep only each row's sort key and where it is in its input file, instead of the whole row; then read the rows back from the input files, in sorted order, to output them. This takes much less memory for wide tables sorted by narrow columns. Rows with equal sort keys are output in input order. Inputs that aren't regular files (such as pipes) can't be read back, so if any input isn't one, this option is ignored.")
 	parser.add_argument('input_paths', type=pathlib.Path, nargs='+', help="Path to one or more files containing CSV data to concatenate into one large file. The first file's header determines the schema of all others; any files with a different header will be skipped.")
 	opts = parser.parse_args()
 
-	sort_columns = [ SortColumn(name) for name in opts.sort_columns ]
+	sort_columns = [ SortColumn.parse(spec) for spec in opts.sort_columns ]
 
 	all_valid = True
 	missing_columns_by_path = {}
@@ -115,6 +584,10 @@ if __name__ == "__main__":
 
 		sys.exit(1)
 
+	if opts.by_offset and not all(path.is_file() for path in opts.input_paths):
+		print('Not all inputs are regular files; sorting whole rows instead of row locations', file=sys.stderr)
+		opts.by_offset = False
+
 	# OK, all the input files have all the requested ordering columns. Proceed.
 	writer = csv.writer(sys.stdout)
 
@@ -122,9 +595,22 @@ if __name__ == "__main__":
 
 	total_included_row_count = 0
 	total_all_row_count = 0
-	for path in opts.input_paths:
-		included_row_count, all_row_count = order_rows(path, sort_columns, writer, opts)
+	if opts.merge:
+		first_header = read_header(opts.input_paths[0])
+		input_paths = []
+		for path in opts.input_paths:
+			if read_header(path) == first_header:
+				input_paths.append(path)
+			else:
+				print('Skipped due to non-matching schema:', path, file=sys.stderr)
+		row_counts_by_file = merge_rows(input_paths, sort_columns, writer, opts)
+	else:
+		input_paths = opts.input_paths
+		row_counts_by_file = []
+		for path in input_paths:
+			row_counts_by_file += order_rows([ path ], sort_columns, writer, opts)
 
+	for path, (included_row_count, all_row_count) in zip(input_paths, row_counts_by_file):
 		print('{}\t{:n}\t{:n}\t{:n}'.format(str(path), included_row_count, all_row_count - included_row_count, all_row_count), file=sys.stderr)
 		total_included_row_count += included_row_count
 		total_all_row_count += all_row_count
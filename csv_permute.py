@@ -9,7 +9,72 @@ def get_from_indexes(orig_row, indexes):
 	permuted_row = [ orig_row[i] for i in indexes ]
 	return permuted_row
 
-def csv_permute(reader, writer, leading_columns):
+# Copied from csv_select
+class LazyRecordReader:
+	"""Reads CSV records from a file opened in text mode, like csv.reader, but splits each record into only as many fields as are needed.
+
+	Each row is a list whose first num_fields items are the same as csv.reader would return, followed by the rest of the record, unsplit. (If num_fields is None, every record is split in full.) Records containing quotes are parsed by csv.reader in full.
+	After each row, raw_record returns the record as it appeared in the file, and full_row returns every field of it."""
+	def __init__(self, f, num_fields: int=None):
+		self.lines = iter(f)
+		self.num_fields = -1 if num_fields is None else num_fields
+		self.quoted_line = None
+		self.raw_lines = []
+		self.csv_reader = csv.reader(self.continued_lines())
+
+	def continued_lines(self):
+		"Feeds csv.reader the line __next__ found a quote in, followed by as many more lines as that record turns out to need."
+		while True:
+			line = self.quoted_line
+			self.quoted_line = None
+			if line is None:
+				line = next(self.lines, None)
+				if line is None:
+					return
+			self.raw_lines.append(line)
+			yield line
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		line = next(self.lines)
+		if '"' in line:
+			self.quoted_line = line
+			self.raw_lines = []
+			self.row = next(self.csv_reader)
+			self.raw = None
+			return self.row
+
+		self.raw = line
+		self.row = None
+		text = self.without_line_break(line)
+		if not text:
+			# csv.reader returns an empty row for a blank line.
+			self.row = []
+			return self.row
+		return text.split(',', self.num_fields)
+
+	@staticmethod
+	def without_line_break(line: str):
+		if line.endswith('\r\n'):
+			return line[:-2]
+		elif line.endswith(('\n', '\r')):
+			return line[:-1]
+		return line
+
+	def full_row(self):
+		if self.row is None:
+			self.row = self.without_line_break(self.raw).split(',')
+		return self.row
+
+	def raw_record(self):
+		"Return the text of the most recent record, ending with the same line terminator csv.writer uses."
+		raw = self.raw if self.raw is not None else ''.join(self.raw_lines)
+		return self.without_line_break(raw) + '\r\n'
+
+def csv_permute(reader, writer, leading_columns, output=None):
+	"Write the rows from reader to writer with the leading columns moved to the front. If reader is a LazyRecordReader and output is the file writer writes to, and the leading columns are already at the front, rows with as many fields as the header are copied from the input as is."
 	header = next(reader)
 	indexes = []
 	try:
@@ -27,9 +92,15 @@ def csv_permute(reader, writer, leading_columns):
 	permuted_header = get_from_indexes(header, indexes)
 	writer.writerow(permuted_header)
 
+	# If there's nothing to move, there's no need to rewrite rows that have exactly as many fields as the header. Other rows are permuted, which drops extra fields and rejects missing ones.
+	copy_rows = isinstance(reader, LazyRecordReader) and output is not None and indexes == list(range(len(header)))
+
 	for orig_row in reader:
-		permuted_row = get_from_indexes(orig_row, indexes)
-		writer.writerow(permuted_row)
+		if copy_rows and len(orig_row) == len(header):
+			output.write(reader.raw_record())
+		else:
+			permuted_row = get_from_indexes(orig_row, indexes)
+			writer.writerow(permuted_row)
 
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser()
@@ -38,6 +109,6 @@ if __name__ == "__main__":
 
 	leading_columns = opts.leading_columns
 
-	reader = csv.reader(sys.stdin)
+	reader = LazyRecordReader(sys.stdin)
 	writer = csv.writer(sys.stdout)
-	csv_permute(reader, writer, leading_columns)
+	csv_permute(reader, writer, leading_columns, output=sys.stdout)
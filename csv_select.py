@@ -6,6 +6,22 @@ import pathlib
 import re
 import argparse
 import csv
+import io
+import array
+import bisect
+import json
+import mmap
+import struct
+import hashlib
+import functools
+import math
+import time
+import heapq
+import collections
+import operator
+import tempfile
+import urllib.parse
+import multiprocessing
 import locale
 
 locale.setlocale(locale.LC_ALL, '')
@@ -106,6 +122,11 @@ types_by_name = {
 	'month': month,
 	'day': day,
 }
+# Types whose comparands can be converted once, up front, and compared directly against each converted value.
+comparand_types = { str, int, float }
+# Date types, by the number of year-month-day components they compare.
+date_scope_lengths = { year: 1, month: 2, day: 3 }
+
 class Evaluator:
 	def __init__(self, comparand):
 		self.comparand = comparand
@@ -184,6 +205,9 @@ class EvaluatorWithout(Evaluator):
 	"IS WITHOUT is meant for use with date values: YEAR, MONTH, and DAY."
 	def __call__(self, value):
 		return value not in self.comparand
+EvaluatorWithin.operator = 'IS WITHIN'
+EvaluatorIncludes.operator = 'INCLUDES'
+EvaluatorWithout.operator = 'IS WITHOUT'
 EvaluatorWithin.inverse = EvaluatorIncludes
 EvaluatorIncludes.inverse = EvaluatorWithin
 operator_classes['IS WITHIN'] = EvaluatorWithin
@@ -194,6 +218,9 @@ class Criterion:
 	def __init__(self, column: SortColumn, evaluator: Evaluator):
 		self.column = column
 		self.evaluator = evaluator
+	def __str__(self):
+		"Describe this criterion the way it was written on the command line."
+		return '{} {} {}'.format(self.column.name, self.evaluator.inverse.operator, self.evaluator.comparand)
 	def evaluate(self, row):
 		try:
 			value = row[self.column.column_index]
@@ -213,6 +240,8 @@ class Criterion:
 class AndCriterion:
 	def __init__(self, subcriteria: list):
 		self.subcriteria = list(subcriteria)
+	def __str__(self):
+		return ' AND '.join(str(sub) for sub in self.subcriteria)
 	def evaluate(self, row):
 		truth = True
 		for sub in self.subcriteria:
@@ -222,6 +251,8 @@ class AndCriterion:
 class OrCriterion:
 	def __init__(self, subcriteria: list):
 		self.subcriteria = list(subcriteria)
+	def __str__(self):
+		return ' OR '.join(str(sub) for sub in self.subcriteria)
 	def evaluate(self, row):
 		truth = False
 		for sub in self.subcriteria:
@@ -231,12 +262,292 @@ class OrCriterion:
 class AlwaysTrue(Criterion):
 	def __init__(self):
 		pass
+	def __str__(self):
+		return 'TRUE'
 	def evaluate(self, row):
 		return True
 
-def select_rows(reader: csv.reader, orig_header: list, criteria: list, writer: csv.writer, opts: argparse.Namespace):
-	row_count = 0
+# Templates for compiled criteria. Like the evaluators, these compute (comparand OP value).
+compiled_operators = {
+	EvaluatorEQ: '{comparand} == {value}',
+	EvaluatorNE: '{comparand} != {value}',
+	EvaluatorLT: '{comparand} < {value}',
+	EvaluatorGT: '{comparand} > {value}',
+	EvaluatorLE: '{comparand} <= {value}',
+	EvaluatorGE: '{comparand} >= {value}',
+}
+
+def bind_constant(namespace: dict, value):
+	"Add value to the namespace a compiled predicate will run in, and return the name it was bound to."
+	name = '_k{:d}'.format(len(namespace))
+	namespace[name] = value
+	return name
+
+def compile_date_containment(comparand: str, value_type):
+	"Return a function equivalent to (comparand in value_type(value)), which parses each value without constructing a DateRange, or None if the comparand is not a date."
+	match = DateRange.ymd_exp.match(comparand)
+	if not match:
+		return None
+	num_components = date_scope_lengths[value_type]
+	expected = tuple(int(x) for x in match.groups() if x is not None)[:num_components]
+	ymd_match = DateRange.ymd_exp.match
+
+	def contains(value):
+		match = ymd_match(value)
+		components = match.groups()[:num_components] if match else (None,)
+		if None in components:
+			# Let DateRange raise the same error it always has.
+			value_type(value)
+		return tuple(map(int, components)) == expected
+	return contains
+
+def compile_criterion(criterion, namespace: dict, date_cache_size: int):
+	"Return the source of a Python expression, in terms of row, that evaluates criterion the way its evaluate method would. Any values the expression needs are bound in namespace. Date comparisons remember the results for up to date_cache_size distinct values, and their caches are added to namespace['date_caches']."
+	if isinstance(criterion, AlwaysTrue):
+		return 'True'
+	elif isinstance(criterion, AndCriterion):
+		return compile_conjunction(criterion.subcriteria, 'and', namespace, date_cache_size)
+	elif isinstance(criterion, OrCriterion):
+		return compile_conjunction(criterion.subcriteria, 'or', namespace, date_cache_size)
+
+	column = criterion.column
+	evaluator = criterion.evaluator
+	value_source = 'row[{:d}]'.format(column.column_index)
+	template = compiled_operators.get(type(evaluator))
+	if template and column.value_type in comparand_types and not column.reverse:
+		if column.value_type is not str:
+			value_source = '{}({})'.format(bind_constant(namespace, column.value_type), value_source)
+		return '(' + template.format(comparand=bind_constant(namespace, evaluator.comparand), value=value_source) + ')'
+	elif type(evaluator) is EvaluatorIncludes and column.value_type in date_scope_lengths:
+		contains = compile_date_containment(evaluator.comparand, column.value_type)
+		if contains:
+			if date_cache_size:
+				# Date columns tend to have few distinct values, so most rows can skip parsing altogether.
+				contains = functools.lru_cache(maxsize=date_cache_size)(contains)
+				namespace['date_caches'].append((str(criterion), contains))
+			return '{}({})'.format(bind_constant(namespace, contains), value_source)
+
+	# No specialization for this criterion; evaluate it the slow way.
+	return '{}({}({}))'.format(bind_constant(namespace, evaluator), bind_constant(namespace, column.parse_value), value_source)
+
+def compile_conjunction(subcriteria: list, conjunction: str, namespace: dict, date_cache_size: int):
+	if not subcriteria:
+		return 'True' if conjunction == 'and' else 'False'
+	return '(' + ' {} '.format(conjunction).join(compile_criterion(sub, namespace, date_cache_size) for sub in subcriteria) + ')'
+
+def evaluate_criteria(criteria: list, row):
+	"Evaluate each of the criteria against row in turn, as select_rows always has. Return True if all of them are satisfied."
+	for criterion in criteria:
+		if not criterion.evaluate(row):
+			return False
+	return True
+
+def compile_criteria(criteria: list, date_cache_size: int=0):
+	"Compile a list of criteria, all of which must be satisfied, into a single predicate function that takes a row and returns True if the row matches. Comparisons are specialized for each criterion's type and operator, so a row is tested without going through the Criterion, SortColumn, and Evaluator methods for every term. The predicate's date_caches attribute lists (description, cached_function) pairs for any date comparisons cached per date_cache_size."
+	date_caches = []
+	namespace = { 'date_caches': date_caches }
+	expression = compile_conjunction(criteria, 'and', namespace, date_cache_size)
+	# Short rows (including empty rows) get the full treatment, including Criterion.evaluate's error reporting.
+	namespace['evaluate_slowly'] = lambda row: evaluate_criteria(criteria, row)
+	source = 'def predicate(row):\n\ttry:\n\t\treturn {}\n\texcept IndexError:\n\t\treturn evaluate_slowly(row)\n'.format(expression)
+	exec(source, namespace)
+	predicate = namespace['predicate']
+	predicate.date_caches = date_caches
+	return predicate
 
+def date_cache_stats(predicate):
+	"Return a list of (description, hits, misses) for each of the compiled predicate's date caches."
+	return [ (description, cached.cache_info().hits, cached.cache_info().misses) for description, cached in predicate.date_caches ]
+
+def report_date_cache_stats(stats: list):
+	for description, hits, misses in stats:
+		print('date cache for {}\t{:n} hits\t{:n} misses'.format(description, hits, misses), file=sys.stderr)
+
+class CriteriaSampler:
+	"""A predicate that evaluates every term of the criteria for each row, measuring how often each term passes and how long it takes, so that the terms can be reordered to short-circuit as early as possible.
+
+	Use it in place of a compiled predicate for the first rows. Once done is True, compile returns a predicate with the terms of each AND ordered by cost per row ruled out, and the terms of each OR by cost per row ruled in.
+	Results (and errors) while sampling are the same as for the terms in their original order. A term that raised an error for any sampled row is never moved ahead of the others, so that the terms that used to rule out its bad values still do. Afterward, a term that raises an error only for rows after the sample may be skipped for them, or reached sooner."""
+	date_caches = []
+
+	def __init__(self, criteria: list, num_rows: int):
+		self.criteria = criteria
+		self.rows_left = num_rows
+		# Each criterion's [evaluations, passes, nanoseconds, errors], by id.
+		self.stats = {}
+		self.leaf_predicates = {}
+		self.prepare(criteria)
+
+	def prepare(self, criteria: list):
+		for criterion in criteria:
+			self.stats[id(criterion)] = [ 0, 0, 0, 0 ]
+			if isinstance(criterion, (AndCriterion, OrCriterion)):
+				self.prepare(criterion.subcriteria)
+			else:
+				self.leaf_predicates[id(criterion)] = compile_criteria([ criterion ])
+
+	@classmethod
+	def is_worthwhile(cls, criteria: list):
+		"Return True if there's more than one way to order the criteria."
+		return len(criteria) > 1 or any(isinstance(criterion, (AndCriterion, OrCriterion)) and cls.is_worthwhile(criterion.subcriteria) for criterion in criteria)
+
+	@property
+	def done(self):
+		return self.rows_left <= 0
+
+	def __call__(self, row):
+		self.rows_left -= 1
+		result, error = self.sample_conjunction(self.criteria, True, row)
+		if error is not None:
+			raise error
+		return result
+
+	def sample(self, criterion, row):
+		"Evaluate criterion against row, recording its stats. Returns (result, error) as evaluating it normally would have produced."
+		start = time.perf_counter_ns()
+		if isinstance(criterion, (AndCriterion, OrCriterion)):
+			result, error = self.sample_conjunction(criterion.subcriteria, isinstance(criterion, AndCriterion), row)
+		else:
+			try:
+				result, error = bool(self.leaf_predicates[id(criterion)](row)), None
+			except Exception as e:
+				result, error = None, e
+		stats = self.stats[id(criterion)]
+		stats[0] += 1
+		stats[1] += bool(result)
+		stats[2] += time.perf_counter_ns() - start
+		stats[3] += error is not None
+		return result, error
+
+	def sample_conjunction(self, subcriteria: list, is_and: bool, row):
+		# Evaluate every subcriterion, so that they all get measured, then work out what short-circuit evaluation in order would have returned or raised.
+		outcomes = [ self.sample(sub, row) for sub in subcriteria ]
+		for result, error in outcomes:
+			if error is not None:
+				return None, error
+			if result != is_and:
+				return result, None
+		return is_and, None
+
+	def ranking(self, criterion, is_and: bool):
+		"Cost per row this criterion decides: how long it takes divided by how often it fails (for AND) or passes (for OR). Infinite for a criterion that raised an error, so that it stays behind the others."
+		evaluations, passes, nanoseconds, errors = self.stats[id(criterion)]
+		if errors:
+			return math.inf
+		if not evaluations:
+			return 0
+		deciding_rate = (evaluations - passes if is_and else passes) / evaluations
+		return nanoseconds / evaluations / deciding_rate if deciding_rate else math.inf
+
+	def reorder(self, subcriteria: list, is_and: bool):
+		reordered = []
+		for sub in sorted(subcriteria, key=lambda sub: self.ranking(sub, is_and)):
+			if isinstance(sub, AndCriterion):
+				sub = AndCriterion(self.reorder(sub.subcriteria, True))
+			elif isinstance(sub, OrCriterion):
+				sub = OrCriterion(self.reorder(sub.subcriteria, False))
+			reordered.append(sub)
+		return reordered
+
+	def compile(self, date_cache_size: int=0):
+		return compile_criteria(self.reorder(self.criteria, True), date_cache_size)
+
+	def report(self):
+		def report_criteria(criteria: list):
+			for criterion in criteria:
+				evaluations, passes, nanoseconds, errors = self.stats[id(criterion)]
+				if evaluations:
+					print('{}\t{:.1%} passed\t{:n} ns per row\t{:n} errors'.format(criterion, passes / evaluations, nanoseconds // evaluations, errors), file=sys.stderr)
+				if isinstance(criterion, (AndCriterion, OrCriterion)):
+					report_criteria(criterion.subcriteria)
+		print('sampled terms:', file=sys.stderr)
+		report_criteria(self.criteria)
+		print('chosen order: {}'.format(' AND '.join(str(criterion) for criterion in self.reorder(self.criteria, True))), file=sys.stderr)
+
+def make_predicate(criteria: list, opts: argparse.Namespace):
+	"Return (predicate, sampler). If the criteria are worth reordering, the predicate is a CriteriaSampler (also returned as sampler), to be replaced by its compiled predicate once it's done. Otherwise, the predicate is compiled as is and sampler is None."
+	if opts.sample_rows and CriteriaSampler.is_worthwhile(criteria):
+		sampler = CriteriaSampler(criteria, opts.sample_rows)
+		return sampler, sampler
+	return compile_criteria(criteria, opts.date_cache_size), None
+
+class LazyRecordReader:
+	"""Reads CSV records from a file opened in text mode, like csv.reader, but splits each record into only as many fields as are needed.
+
+	Each row is a list whose first num_fields items are the same as csv.reader would return, followed by the rest of the record, unsplit. (If num_fields is None, every record is split in full.) Records containing quotes are parsed by csv.reader in full.
+	After each row, raw_record returns the record as it appeared in the file, and full_row returns every field of it."""
+	def __init__(self, f, num_fields: int=None):
+		self.lines = iter(f)
+		self.num_fields = -1 if num_fields is None else num_fields
+		self.quoted_line = None
+		self.raw_lines = []
+		self.csv_reader = csv.reader(self.continued_lines())
+
+	def continued_lines(self):
+		"Feeds csv.reader the line __next__ found a quote in, followed by as many more lines as that record turns out to need."
+		while True:
+			line = self.quoted_line
+			self.quoted_line = None
+			if line is None:
+				line = next(self.lines, None)
+				if line is None:
+					return
+			self.raw_lines.append(line)
+			yield line
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		line = next(self.lines)
+		if '"' in line:
+			self.quoted_line = line
+			self.raw_lines = []
+			self.row = next(self.csv_reader)
+			self.raw = None
+			return self.row
+
+		self.raw = line
+		self.row = None
+		text = self.without_line_break(line)
+		if not text:
+			# csv.reader returns an empty row for a blank line.
+			self.row = []
+			return self.row
+		return text.split(',', self.num_fields)
+
+	@staticmethod
+	def without_line_break(line: str):
+		if line.endswith('\r\n'):
+			return line[:-2]
+		elif line.endswith(('\n', '\r')):
+			return line[:-1]
+		return line
+
+	def full_row(self):
+		if self.row is None:
+			self.row = self.without_line_break(self.raw).split(',')
+		return self.row
+
+	def raw_record(self):
+		"Return the text of the most recent record, ending with the same line terminator csv.writer uses."
+		raw = self.raw if self.raw is not None else ''.join(self.raw_lines)
+		return self.without_line_break(raw) + '\r\n'
+
+def fields_needed(criteria: list, indexes: list):
+	"Return the number of leading fields of each row needed to evaluate the criteria and output the columns at indexes (None meaning all columns)."
+	needed = 0
+	for criterion in criteria:
+		if isinstance(criterion, (AndCriterion, OrCriterion)):
+			needed = max(needed, fields_needed(criterion.subcriteria, []))
+		elif not isinstance(criterion, AlwaysTrue):
+			needed = max(needed, criterion.column.column_index + 1)
+	if indexes:
+		needed = max(needed, max(indexes) + 1)
+	return needed
+
+def select_columns(orig_header: list, opts: argparse.Namespace):
+	"Return (indexes, munged_header), where indexes lists the columns to output (or is None to output every column) and munged_header is the header to output, after any renames."
 	columns_of_interest = opts.only_columns
 	if columns_of_interest:
 		# TODO: Use csv.reader to parse this
@@ -257,51 +568,775 @@ def select_rows(reader: csv.reader, orig_header: list, criteria: list, writer: c
 
 		munged_header = get_from_indexes(orig_header, indexes)
 	else:
+		indexes = None
 		munged_header = orig_header
 	munged_header = apply_renames(munged_header, opts.column_renames)
+	return indexes, munged_header
+
+def munge_row(orig_row: list, indexes: list, row_count: int):
+	try:
+		return tuple(
+			orig_row
+			if indexes is None
+			else get_from_indexes(orig_row, indexes)
+		)
+	except IndexError:
+		print('Error on row #{:n}, which is too short (or contains an unescaped line break): indexes are {} but row only has {:n} columns'.format(row_count, indexes, len(orig_row)), file=sys.stderr)
+		print('Row: {}'.format(orig_row), file=sys.stderr)
+		raise
+
+def parse_byte_count(count_str: str):
+	"Parse a number of bytes, optionally followed by K, M, G, or T (powers of 1024)."
+	multipliers = { 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40 }
+	count_str = count_str.strip().upper().rstrip('B')
+	multiplier = 1
+	if count_str and count_str[-1] in multipliers:
+		multiplier = multipliers[count_str[-1]]
+		count_str = count_str[:-1]
+	return int(float(count_str) * multiplier)
+
+class DistinctRows:
+	"""Keeps track of which rows have been seen, for --distinct, in a bounded amount of memory.
+
+	Each row is remembered as a fixed-width digest rather than the row itself. Once memory_budget bytes' worth of digests have been collected, add stops accepting new rows immediately: it writes them to temporary files, partitioned by digest, and deferred_rows sorts them out after all rows have been added. Either way, exactly the first occurrence of each row is output, in the order the rows were added."""
+	digest_size = 16
+	# Approximate memory cost of one digest in a set: the bytes object plus its share of the hash table.
+	bytes_per_digest = 80
+	num_partitions = 256
+
+	def __init__(self, memory_budget: int):
+		self.max_digests = max(1, memory_budget // self.bytes_per_digest)
+		self.digests = set()
+		self.temp_dir = None
+		self.num_deferred = 0
+
+	def digest(self, row):
+		return hashlib.blake2b(repr(tuple(row)).encode('utf-8', 'surrogatepass'), digest_size=self.digest_size).digest()
+
+	def add(self, row):
+		"Return True if row hasn't been seen before and should be output now. Return False if it's a duplicate or has been deferred until deferred_rows."
+		digest = self.digest(row)
+		if digest in self.digests:
+			return False
+		if self.temp_dir is None:
+			if len(self.digests) < self.max_digests:
+				self.digests.add(digest)
+				return True
+			self.start_spilling()
+
+		# Whether this is a duplicate of another deferred row gets sorted out later.
+		self.candidate_writers[digest[0] % self.num_partitions].writerow([ self.num_deferred, digest.hex() ] + list(row))
+		self.num_deferred += 1
+		return False
+
+	def start_spilling(self):
+		self.temp_dir = tempfile.TemporaryDirectory(prefix='csv_select-distinct-')
+		self.candidate_files = [ self.open_partition('candidates', i, 'w') for i in range(self.num_partitions) ]
+		self.candidate_writers = [ csv.writer(f) for f in self.candidate_files ]
+
+	def open_partition(self, kind: str, partition: int, mode: str):
+		path = os.path.join(self.temp_dir.name, '{}-{:03d}.csv'.format(kind, partition))
+		return open(path, mode, newline='', encoding='utf-8', errors='surrogatepass')
+
+	def deduplicate_partition(self, partition: int, digests_before: set):
+		"Write out the first occurrence of each deferred row in one partition that wasn't seen before spilling started."
+		seen = digests_before
+		with self.open_partition('candidates', partition, 'r') as candidates_file:
+			with self.open_partition('survivors', partition, 'w') as survivors_file:
+				survivors_writer = csv.writer(survivors_file)
+				for candidate in csv.reader(candidates_file):
+					digest = bytes.fromhex(candidate[1])
+					if digest not in seen:
+						seen.add(digest)
+						survivors_writer.writerow([ candidate[0] ] + candidate[2:])
+
+	def read_survivors(self, partition: int):
+		with self.open_partition('survivors', partition, 'r') as survivors_file:
+			for survivor in csv.reader(survivors_file):
+				yield int(survivor[0]), survivor[1:]
+
+	def deferred_rows(self):
+		"After all rows have been added, yield the deferred rows that should be output, in the order they were added."
+		if self.temp_dir is None:
+			return
+		for f in self.candidate_files:
+			f.close()
+
+		# Split the digests collected before spilling by partition, then let them go, so that only one partition's worth of digests is in memory at a time.
+		digests_by_partition = [ set() for i in range(self.num_partitions) ]
+		for digest in self.digests:
+			digests_by_partition[digest[0] % self.num_partitions].add(digest)
+		self.digests = set()
+		for partition in range(self.num_partitions):
+			self.deduplicate_partition(partition, digests_by_partition[partition])
+			digests_by_partition[partition] = None
+
+		merged = heapq.merge(*(self.read_survivors(partition) for partition in range(self.num_partitions)), key=operator.itemgetter(0))
+		for sequence_number, row in merged:
+			yield row
+
+	def close(self):
+		if self.temp_dir is not None:
+			self.temp_dir.cleanup()
+
+def select_rows(reader: csv.reader, orig_header: list, criteria: list, writer: csv.writer, opts: argparse.Namespace, output=None):
+	"Evaluate the criteria for every row from reader (a csv.reader, LazyRecordReader, or any iterable of rows), and write matching rows to writer. If reader is a LazyRecordReader and output is the file writer writes to, rows output with all of their columns are copied from the input as is, rather than being parsed in full and written by writer. Returns the number of rows matched."
+	row_count = 0
+
+	indexes, munged_header = select_columns(orig_header, opts)
+	lazy = isinstance(reader, LazyRecordReader)
+	pass_through = lazy and output is not None and indexes is None
 
 	if opts.distinct:
-		previous_rows = set()
-		next_count_check = 1000
+		distinct_rows = DistinctRows(opts.memory_budget)
+	predicate, sampler = make_predicate(criteria, opts)
 	for orig_row in reader:
-		for criterion in criteria:
-			try:
-				if not criterion.evaluate(orig_row):
-					break
-			except:
-				print('Error evaluating criteria for row #{:n}:'.format(row_count), file=sys.stderr)
-				raise
-		else:
+		try:
+			matched = predicate(orig_row)
+		except:
+			print('Error evaluating criteria for row #{:n}:'.format(row_count), file=sys.stderr)
+			raise
+		if sampler is not None and sampler.done:
+			predicate = sampler.compile(opts.date_cache_size)
+			if opts.verbose:
+				sampler.report()
+			sampler = None
+		if matched:
 			counted = 1
 			if opts.print_every_match:
 
 				if row_count == 0:
 					writer.writerow(munged_header)
-				try:
-					munged_row = tuple(
-						orig_row
-						if not columns_of_interest
-						else get_from_indexes(orig_row, indexes)
-					)
-				except IndexError:
-					print('Error on row #{:n}, which is too short (or contains an unescaped line break): indexes are {} but row only has {:n} columns'.format(row_count, indexes, len(orig_row)), file=sys.stderr)
-					print('Row: {}'.format(orig_row), file=sys.stderr)
-					raise
-
-				if opts.distinct and munged_row in previous_rows:
+				munged_row = munge_row(reader.full_row() if lazy and indexes is None else orig_row, indexes, row_count)
+
+				if opts.distinct and not distinct_rows.add(munged_row):
 					counted = 0
+				elif pass_through:
+					output.write(reader.raw_record())
 				else:
 					writer.writerow(munged_row)
-					if opts.distinct:
-						previous_rows.add(munged_row)
 
 			row_count += counted
 		if opts.limit and row_count >= opts.limit:
 			break
 
+	if opts.distinct:
+		row_count = write_deferred_rows(distinct_rows, writer, munged_header, row_count, opts)
+	if opts.verbose:
+		report_date_cache_stats(date_cache_stats(predicate))
+
+	return row_count
+
+def write_deferred_rows(distinct_rows: DistinctRows, writer: csv.writer, munged_header: list, row_count: int, opts: argparse.Namespace):
+	"Write the rows --distinct deferred after running out of memory, up to the limit. Returns the updated row count."
+	for munged_row in distinct_rows.deferred_rows():
+		if opts.limit and row_count >= opts.limit:
+			break
+		if row_count == 0:
+			writer.writerow(munged_header)
+		writer.writerow(munged_row)
+		row_count += 1
+	distinct_rows.close()
+	return row_count
+
+# Size of the byte ranges that --jobs divides the input into. Each range is read whole by one worker process.
+parallel_chunk_size = 32 * 1024 * 1024
+
+def find_header_end(path: pathlib.Path):
+	"Return the byte offset just past the header record of the file at path."
+	offset = 0
+	quote_count = 0
+	with open(path, 'rb') as f:
+		for line in f:
+			offset += len(line)
+			quote_count += line.count(b'"')
+			if quote_count % 2 == 0:
+				break
+	return offset
+
+def scan_for_record_starts(path: pathlib.Path, start: int, end: int):
+	"""Count the quote characters in the given byte range of the file at path, and find where records could start within that range.
+
+	Any line break that follows an even number of quotes (counting from the start of the file) ends a record; any line break within a quoted field follows an odd number. Since the quotes before this range haven't been counted yet, return (quote_count, even_start, odd_start): the number of quotes in the range, the offset just past the first line break after an even number of quotes counted from start, and likewise for an odd number. Either offset is None if there is no such line break in the range.
+	This assumes quotes appear only around quoted fields, as csv.writer writes them."""
+	with open(path, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+
+	starts = [ None, None ]
+	quote_count = 0
+	scanned = 0
+	line_end = data.find(b'\n')
+	while line_end >= 0:
+		quote_count += data.count(b'"', scanned, line_end)
+		scanned = line_end
+		parity = quote_count % 2
+		if starts[parity] is None:
+			starts[parity] = start + line_end + 1
+			if None not in starts:
+				break
+		# The parity can't change until the next quote, so skip to the first line break after it.
+		next_quote = data.find(b'"', line_end)
+		if next_quote < 0:
+			break
+		line_end = data.find(b'\n', next_quote)
+
+	return data.count(b'"'), starts[0], starts[1]
+
+def record_aligned_ranges(path: pathlib.Path, start: int, pool):
+	"Divide the file at path, from start (which must be the start of a record) to the end, into byte ranges of roughly parallel_chunk_size that each begin and end on a record boundary. Uses pool to scan the file in parallel. Returns a list of (start, end) pairs."
+	size = os.path.getsize(path)
+	range_starts = list(range(start, size, parallel_chunk_size))
+	scans = pool.starmap(scan_for_record_starts, [ (path, range_start, min(range_start + parallel_chunk_size, size)) for range_start in range_starts ])
+
+	boundaries = [ start ]
+	quotes_before = 0
+	for i, (quote_count, even_start, odd_start) in enumerate(scans):
+		if i > 0:
+			record_start = even_start if quotes_before % 2 == 0 else odd_start
+			if record_start is not None and record_start < size:
+				boundaries.append(record_start)
+		quotes_before += quote_count
+	boundaries.append(size)
+
+	return list(zip(boundaries[:-1], boundaries[1:]))
+
+# Set up in each worker process by init_select_worker.
+worker_state = None
+
+def init_select_worker(path: pathlib.Path, criteria: list, indexes: list, opts: argparse.Namespace):
+	global worker_state
+	predicate, sampler = make_predicate(criteria, opts)
+	# Each worker samples the first rows it sees, then keeps the order it chose for the rest of its chunks.
+	worker_state = {
+		'path': path,
+		'predicate': predicate,
+		'sampler': sampler,
+		'indexes': indexes,
+		'fields_needed': fields_needed(criteria, indexes),
+		'opts': opts,
+	}
+
+def select_chunk(byte_range: tuple):
+	"Worker function for --jobs. Evaluate the criteria for every record in a byte range of the input. Return (match_count, munged_rows, date_cache_stats), with munged_rows None if only counting. Stops early at the limit, if any."
+	path = worker_state['path']
+	predicate = worker_state['predicate']
+	sampler = worker_state['sampler']
+	indexes = worker_state['indexes']
+	opts = worker_state['opts']
+	start, end = byte_range
+	# The caches live as long as the worker process, so report only this chunk's share of the hits and misses.
+	stats_before = date_cache_stats(predicate)
+	with open(path, 'rb') as f:
+		f.seek(start)
+		data = f.read(end - start)
+	reader = LazyRecordReader(io.TextIOWrapper(io.BytesIO(data), encoding=opts.input_encoding), worker_state['fields_needed'])
+
+	row_count = 0
+	munged_rows = [] if opts.print_every_match else None
+	for orig_row in reader:
+		try:
+			matched = predicate(orig_row)
+		except:
+			print('Error evaluating criteria for row #{:n} of byte range {:n}–{:n}:'.format(row_count, start, end), file=sys.stderr)
+			raise
+		if sampler is not None and sampler.done:
+			predicate = worker_state['predicate'] = sampler.compile(opts.date_cache_size)
+			sampler = worker_state['sampler'] = None
+			stats_before = date_cache_stats(predicate)
+		if matched:
+			if munged_rows is not None:
+				munged_rows.append(munge_row(reader.full_row() if indexes is None else orig_row, indexes, row_count))
+			row_count += 1
+			# Rows after the limit can't be output, unless --distinct might drop some of the ones before it.
+			if opts.limit and row_count >= opts.limit and not opts.distinct:
+				break
+
+	chunk_date_cache_stats = [ (description, hits - hits_before, misses - misses_before) for (description, hits, misses), (_, hits_before, misses_before) in zip(date_cache_stats(predicate), stats_before) ]
+	return row_count, munged_rows, chunk_date_cache_stats
+
+def imap_bounded(pool: multiprocessing.Pool, function, iterable, window: int):
+	"Like pool.imap, but with at most window calls submitted whose results haven't been consumed yet. pool.imap submits every call up front and keeps every result until it's consumed, so when results are consumed more slowly than they're made (such as when they're being written to a slow pipe), they pile up in memory."
+	pending = collections.deque()
+	for item in iterable:
+		pending.append(pool.apply_async(function, (item,)))
+		if len(pending) >= window:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+def select_rows_parallel(path: pathlib.Path, orig_header: list, criteria: list, writer: csv.writer, opts: argparse.Namespace):
+	"Equivalent to select_rows, but divides the file into record-aligned byte ranges and evaluates them in opts.jobs worker processes. Matches are output in input order."
+	row_count = 0
+
+	indexes, munged_header = select_columns(orig_header, opts)
+
+	if opts.distinct:
+		distinct_rows = DistinctRows(opts.memory_budget)
+	with multiprocessing.Pool(opts.jobs, initializer=init_select_worker, initargs=(path, criteria, indexes, opts)) as pool:
+		byte_ranges = record_aligned_ranges(path, find_header_end(path), pool)
+		total_date_cache_stats = None
+		# Two chunks per worker keeps every worker busy while the matches from earlier chunks are written out.
+		for match_count, munged_rows, chunk_date_cache_stats in imap_bounded(pool, select_chunk, byte_ranges, 2 * opts.jobs):
+			if total_date_cache_stats is None:
+				total_date_cache_stats = chunk_date_cache_stats
+			else:
+				total_date_cache_stats = [ (description, total_hits + hits, total_misses + misses) for (description, total_hits, total_misses), (_, hits, misses) in zip(total_date_cache_stats, chunk_date_cache_stats) ]
+			if not opts.print_every_match:
+				row_count += match_count
+			else:
+				for munged_row in munged_rows:
+					if row_count == 0:
+						writer.writerow(munged_header)
+
+					if opts.distinct and not distinct_rows.add(munged_row):
+						continue
+					writer.writerow(munged_row)
+
+					row_count += 1
+					if opts.limit and row_count >= opts.limit:
+						break
+			if opts.limit and row_count >= opts.limit:
+				row_count = opts.limit
+				break
+
+	if opts.distinct:
+		row_count = write_deferred_rows(distinct_rows, writer, munged_header, row_count, opts)
+	if opts.verbose and total_date_cache_stats:
+		report_date_cache_stats(total_date_cache_stats)
+
 	return row_count
 
-def csv_select(f, path: str, writer, opts):
+def iter_records_with_offsets(binary_file, encoding: str, offset: int=0):
+	"Parse CSV records from a file opened in binary mode and positioned at offset (the start of a record). Yields (offset, length, row) for each record, where offset and length locate the bytes of that record, including its line break(s)."
+	position = offset
+	def lines():
+		nonlocal position
+		for line in binary_file:
+			position += len(line)
+			if line.endswith(b'\r\n'):
+				# Translate line breaks the way a file opened in text mode would.
+				line = line[:-2] + b'\n'
+			yield line.decode(encoding)
+
+	record_start = offset
+	# csv.reader pulls lines only as it needs them, so after each record, position is the end of that record.
+	for row in csv.reader(lines()):
+		yield record_start, position - record_start, row
+		record_start = position
+
+def date_key(value: str):
+	"Return a date as a tuple of its year, month, and day components (as many as it has), or an empty tuple if it isn't a date."
+	match = DateRange.ymd_exp.match(value)
+	if not match:
+		return ()
+	return tuple(int(x) for x in match.groups() if x is not None)
+
+index_key_types = {
+	'str': str,
+	'int': int,
+	'float': float,
+	'date': date_key,
+}
+index_types_by_value_type = {
+	str: 'str',
+	int: 'int',
+	float: 'float',
+	year: 'date',
+	month: 'date',
+	day: 'date',
+}
+# Only use an index if it narrows the search down to this fraction of the rows or fewer. Seeking to more rows than that is slower than reading the whole file.
+index_selectivity_limit = 0.25
+
+def index_path_for(path: pathlib.Path, column_name: str):
+	return path.with_name('{}.{}.csvindex'.format(path.name, urllib.parse.quote(column_name, safe='')))
+
+def parse_index_spec(spec: str):
+	"Parse a --build-index argument of the form COLUMN or COLUMN:TYPE. Returns (column_name, type_name)."
+	column_name, sep, type_name = spec.rpartition(':')
+	if sep and type_name in index_key_types:
+		return column_name, type_name
+	return spec, 'str'
+
+def build_index(path: pathlib.Path, column_name: str, type_name: str, encoding: str):
+	"""Write an index of one column of the CSV file at path to a sidecar file next to it. Returns the number of rows indexed.
+
+	The index file consists of a magic number, the length of a JSON header describing the index and the file it indexes, the header itself, then three arrays: the byte offset of each row in the CSV file, the offset of each key within the key data, and the key data (each row's value for the column, encoded as UTF-8). The rows are sorted by their value for the column, interpreted as type_name. Rows whose value is NaN are left out."""
+	key_type = index_key_types[type_name]
+	stat = os.stat(path)
+	entries = []
+	with open(path, 'rb') as binary_file:
+		records = iter_records_with_offsets(binary_file, encoding)
+		header_offset, header_length, header = next(records)
+		try:
+			column_idx = header.index(column_name)
+		except ValueError:
+			sys.exit('Column {} not found among columns: {}'.format(repr(column_name), repr(header)))
+
+		for row_num, (offset, length, row) in enumerate(records):
+			value = row[column_idx] if row else ''
+			try:
+				key = key_type(value)
+			except ValueError:
+				sys.exit("Can't index column {} as {}: value {} on row #{:n} is not a valid {}".format(repr(column_name), type_name, repr(value), row_num, type_name))
+			if key != key:
+				# NaN doesn't sort with other numbers (which would break the binary search), and never satisfies a comparison anyway, so leave it out.
+				continue
+			entries.append((key, offset, value))
+	entries.sort(key=lambda entry: entry[:2])
+
+	key_data = [ value.encode('utf-8') for key, offset, value in entries ]
+	key_offsets = array.array('Q', [ 0 ])
+	for key_bytes in key_data:
+		key_offsets.append(key_offsets[-1] + len(key_bytes))
+
+	index_header = json.dumps({
+		'column': column_name,
+		'type': type_name,
+		'count': len(entries),
+		'source_size': stat.st_size,
+		'source_mtime_ns': stat.st_mtime_ns,
+	}).encode('utf-8')
+	# Pad the header so that the arrays are aligned.
+	index_header += b' ' * (-len(index_header) % 8)
+
+	with open(index_path_for(path, column_name), 'wb') as index_file:
+		index_file.write(ColumnIndex.magic)
+		index_file.write(struct.pack('<Q', len(index_header)))
+		index_file.write(index_header)
+		index_file.write(array.array('Q', (offset for key, offset, value in entries)).tobytes())
+		index_file.write(key_offsets.tobytes())
+		for key_bytes in key_data:
+			index_file.write(key_bytes)
+
+	return len(entries)
+
+class ColumnIndex:
+	"An index built by build_index, memory-mapped. Indexing an instance returns the key of that row (in sorted order), so it can be searched with bisect."
+	magic = b'csvselix'
+
+	@classmethod
+	def open(cls, path: pathlib.Path, column_name: str):
+		"Return the index for the given column of the CSV file at path, or None if there isn't one or it is out of date."
+		try:
+			index_file = open(index_path_for(path, column_name), 'rb')
+		except FileNotFoundError:
+			return None
+		with index_file:
+			if index_file.read(len(cls.magic)) != cls.magic:
+				return None
+			header_length, = struct.unpack('<Q', index_file.read(8))
+			index_header = json.loads(index_file.read(header_length))
+			stat = os.stat(path)
+			if (index_header['source_size'], index_header['source_mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+				print('Ignoring out-of-date index of column {!r}; rebuild it with --build-index'.format(column_name), file=sys.stderr)
+				return None
+			mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+		return cls(index_header, mapped, len(cls.magic) + 8 + header_length)
+
+	def __init__(self, index_header: dict, mapped: mmap.mmap, arrays_offset: int):
+		self.column_name = index_header['column']
+		self.type_name = index_header['type']
+		self.key_type = index_key_types[self.type_name]
+		self.count = index_header['count']
+		self.mapped = mapped
+		view = memoryview(mapped)
+		row_offsets_end = arrays_offset + 8 * self.count
+		key_offsets_end = row_offsets_end + 8 * (self.count + 1)
+		self.row_offsets = view[arrays_offset:row_offsets_end].cast('Q')
+		self.key_offsets = view[row_offsets_end:key_offsets_end].cast('Q')
+		self.key_data_offset = key_offsets_end
+
+	def __len__(self):
+		return self.count
+	def __getitem__(self, i):
+		start = self.key_data_offset + self.key_offsets[i]
+		end = self.key_data_offset + self.key_offsets[i + 1]
+		return self.key_type(self.mapped[start:end].decode('utf-8'))
+
+	def find(self, criterion: Criterion):
+		"Return the range of sorted positions of rows that could satisfy criterion, or None if this index can't help with it."
+		column = criterion.column
+		if column.reverse or index_types_by_value_type.get(column.value_type) != self.type_name:
+			return None
+
+		evaluator_class = type(criterion.evaluator)
+		comparand = criterion.evaluator.comparand
+		# As always, the evaluator computes (comparand OP value).
+		if evaluator_class is EvaluatorIncludes and column.value_type in date_scope_lengths:
+			num_components = date_scope_lengths[column.value_type]
+			expected = date_key(comparand)[:num_components]
+			if len(expected) < num_components:
+				return range(0)
+			# Every date that starts with the expected components sorts between them and the next year/month/day.
+			following = expected[:-1] + (expected[-1] + 1,)
+			return range(bisect.bisect_left(self, expected), bisect.bisect_left(self, following))
+		elif column.value_type not in comparand_types:
+			# Other comparisons of dates compare DateRange objects, which don't order the same way as the index's keys.
+			return None
+		elif evaluator_class is EvaluatorEQ:
+			return range(bisect.bisect_left(self, comparand), bisect.bisect_right(self, comparand))
+		elif evaluator_class is EvaluatorGT:
+			return range(0, bisect.bisect_left(self, comparand))
+		elif evaluator_class is EvaluatorGE:
+			return range(0, bisect.bisect_right(self, comparand))
+		elif evaluator_class is EvaluatorLT:
+			return range(bisect.bisect_right(self, comparand), self.count)
+		elif evaluator_class is EvaluatorLE:
+			return range(bisect.bisect_left(self, comparand), self.count)
+		return None
+
+	def close(self):
+		self.row_offsets.release()
+		self.key_offsets.release()
+		self.mapped.close()
+
+def required_criteria(criteria: list):
+	"Return the terms that every matching row must satisfy. Only these can rule out rows without reading them."
+	required = []
+	for criterion in criteria:
+		if isinstance(criterion, AndCriterion):
+			required += required_criteria(criterion.subcriteria)
+		elif isinstance(criterion, Criterion) and not isinstance(criterion, AlwaysTrue):
+			required.append(criterion)
+	return required
+
+def find_indexed_candidates(path: pathlib.Path, criteria: list):
+	"Look for an index that can narrow down which rows of the file at path could satisfy all of the criteria. Returns a sorted list of the byte offsets of those rows, or None if no index is available or selective enough to be worth using."
+	best = None
+	indexes_by_column = {}
+	try:
+		for criterion in required_criteria(criteria):
+			column_name = criterion.column.name
+			if column_name not in indexes_by_column:
+				indexes_by_column[column_name] = ColumnIndex.open(path, column_name)
+			index = indexes_by_column[column_name]
+			if index is None:
+				continue
+			found = index.find(criterion)
+			if found is not None and (best is None or len(found) < len(best[1])):
+				best = (index, found)
+
+		if best is None:
+			return None
+		index, found = best
+		if len(found) > index_selectivity_limit * len(index):
+			return None
+		return sorted(index.row_offsets[found.start:found.stop])
+	finally:
+		for index in indexes_by_column.values():
+			if index is not None:
+				index.close()
+
+def read_records_at(binary_file, offsets: list, encoding: str):
+	"Yield the row starting at each of the given byte offsets of a file opened in binary mode."
+	for offset in offsets:
+		binary_file.seek(offset)
+		for record_offset, length, row in iter_records_with_offsets(binary_file, encoding, offset):
+			yield row
+			break
+
+def stats_path_for(path: pathlib.Path):
+	return path.with_name(path.name + '.csvstats')
+
+# Version of the format of the statistics written by build_stats. Statistics in any other format are ignored.
+stats_format_version = 2
+
+class ColumnZone:
+	"Statistics for one column's values within one block of rows: the minimum and maximum values as strings, the number of empty values, and the minimum and maximum of the non-empty values as integers, as floats (leaving out NaN, which compares false to everything), and as dates (None if any non-empty value isn't one)."
+	def __init__(self):
+		self.min = self.max = None
+		self.nulls = 0
+		self.int_min = self.int_max = None
+		self.integral = True
+		self.number_min = self.number_max = None
+		self.numeric = True
+		self.date_min = self.date_max = None
+		self.datelike = True
+
+	def add(self, value: str):
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		if not value:
+			self.nulls += 1
+			return
+
+		if self.integral:
+			# Kept separately from the floats, which can't represent every integer exactly.
+			try:
+				integer = int(value)
+			except ValueError:
+				self.integral = False
+			else:
+				if self.int_min is None or integer < self.int_min:
+					self.int_min = integer
+				if self.int_max is None or integer > self.int_max:
+					self.int_max = integer
+		if self.numeric:
+			try:
+				number = float(value)
+			except ValueError:
+				self.numeric = False
+			else:
+				if not math.isnan(number):
+					if self.number_min is None or number < self.number_min:
+						self.number_min = number
+					if self.number_max is None or number > self.number_max:
+						self.number_max = number
+		if self.datelike:
+			date = date_key(value)
+			if not date:
+				self.datelike = False
+			else:
+				if self.date_min is None or date < self.date_min:
+					self.date_min = date
+				if self.date_max is None or date > self.date_max:
+					self.date_max = date
+
+	def to_list(self):
+		return [
+			self.min, self.max, self.nulls,
+			self.int_min if self.integral else None, self.int_max if self.integral else None,
+			self.number_min if self.numeric else None, self.number_max if self.numeric else None,
+			self.date_min if self.datelike else None, self.date_max if self.datelike else None,
+		]
+
+def build_stats(path: pathlib.Path, column_names: list, block_size: int, encoding: str):
+	"""Divide the CSV file at path into blocks of about block_size bytes, and write a sidecar file next to it with ColumnZone statistics for each of the given columns in each block. Returns the number of blocks.
+
+	The stats file is JSON: an object describing the file, whose "blocks" are each [start, end, row_count, { column_name: ColumnZone.to_list() }], with start and end being byte offsets."""
+	stat = os.stat(path)
+	blocks = []
+	with open(path, 'rb') as binary_file:
+		records = iter_records_with_offsets(binary_file, encoding)
+		header_offset, header_length, header = next(records)
+		column_indexes = []
+		for column_name in column_names:
+			try:
+				column_indexes.append(header.index(column_name))
+			except ValueError:
+				sys.exit('Column {} not found among columns: {}'.format(repr(column_name), repr(header)))
+
+		def finish_block(end):
+			blocks.append([ block_start, end, block_rows, { column_name: zone.to_list() for column_name, zone in zip(column_names, zones) } ])
+
+		block_start = header_offset + header_length
+		block_rows = 0
+		zones = [ ColumnZone() for column_name in column_names ]
+		for offset, length, row in records:
+			if offset - block_start >= block_size:
+				finish_block(offset)
+				block_start = offset
+				block_rows = 0
+				zones = [ ColumnZone() for column_name in column_names ]
+			for zone, column_idx in zip(zones, column_indexes):
+				zone.add(row[column_idx] if column_idx < len(row) else '')
+			block_rows += 1
+		if block_rows:
+			finish_block(offset + length)
+
+	with open(stats_path_for(path), 'w') as stats_file:
+		json.dump({
+			'version': stats_format_version,
+			'columns': column_names,
+			'source_size': stat.st_size,
+			'source_mtime_ns': stat.st_mtime_ns,
+			'blocks': blocks,
+		}, stats_file)
+
+	return len(blocks)
+
+def zone_may_match(criterion: Criterion, zone: list):
+	"Return False if the statistics for a block show that none of its rows can satisfy criterion. Return True if some might (or if the statistics can't tell)."
+	str_min, str_max, nulls, int_min, int_max, number_min, number_max, date_min, date_max = zone
+	column = criterion.column
+	evaluator_class = type(criterion.evaluator)
+	comparand = criterion.evaluator.comparand
+	if column.reverse or str_min is None:
+		return True
+
+	# Empty values can't be parsed as numbers or dates, so they would have to be read to be reported.
+	if column.value_type is str:
+		lowest, highest = str_min, str_max
+	elif column.value_type is int:
+		if nulls or int_min is None:
+			return True
+		lowest, highest = int_min, int_max
+	elif column.value_type is float:
+		if nulls or number_min is None:
+			return True
+		lowest, highest = number_min, number_max
+	elif column.value_type in date_scope_lengths and evaluator_class is EvaluatorIncludes:
+		if nulls or date_min is None:
+			return True
+		num_components = date_scope_lengths[column.value_type]
+		expected = date_key(comparand)[:num_components]
+		if len(expected) < num_components:
+			return True
+		following = expected[:-1] + (expected[-1] + 1,)
+		return not (tuple(date_max) < expected or tuple(date_min) >= following)
+	else:
+		return True
+
+	# As always, the evaluator computes (comparand OP value).
+	if evaluator_class is EvaluatorEQ:
+		return lowest <= comparand <= highest
+	elif evaluator_class is EvaluatorGT:
+		return lowest < comparand
+	elif evaluator_class is EvaluatorGE:
+		return lowest <= comparand
+	elif evaluator_class is EvaluatorLT:
+		return highest > comparand
+	elif evaluator_class is EvaluatorLE:
+		return highest >= comparand
+	return True
+
+def find_candidate_blocks(path: pathlib.Path, criteria: list):
+	"Use the statistics built with --build-stats, if any, to rule out blocks of the file at path in which no row can satisfy all of the criteria. Returns a list of (start, end) byte ranges to read, or None if no block could be ruled out."
+	try:
+		stats_file = open(stats_path_for(path), 'r')
+	except FileNotFoundError:
+		return None
+	with stats_file:
+		stats = json.load(stats_file)
+	stat = os.stat(path)
+	if stats.get('version') != stats_format_version:
+		print('Ignoring statistics in an old format; rebuild them with --build-stats', file=sys.stderr)
+		return None
+	if (stats['source_size'], stats['source_mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+		print('Ignoring out-of-date statistics; rebuild them with --build-stats', file=sys.stderr)
+		return None
+
+	applicable = [ criterion for criterion in required_criteria(criteria) if criterion.column.name in stats['columns'] ]
+	if not applicable:
+		return None
+
+	ranges = []
+	for start, end, row_count, zones in stats['blocks']:
+		if all(zone_may_match(criterion, zones[criterion.column.name]) for criterion in applicable):
+			if ranges and ranges[-1][1] == start:
+				# Read adjacent blocks in one go.
+				ranges[-1] = (ranges[-1][0], end)
+			else:
+				ranges.append((start, end))
+
+	if len(ranges) == 1 and ranges[0] == (stats['blocks'][0][0], stats['blocks'][-1][1]):
+		return None
+	return ranges
+
+def read_records_in_ranges(binary_file, byte_ranges: list, encoding: str):
+	"Yield each row in each of the given (start, end) byte ranges of a file opened in binary mode. Each range must start and end on a record boundary."
+	for start, end in byte_ranges:
+		binary_file.seek(start)
+		for offset, length, row in iter_records_with_offsets(binary_file, encoding, start):
+			yield row
+			if offset + length >= end:
+				break
+
+def csv_select(f, path: str, writer, opts, output=None):
 	reader = csv.reader(f)
 	header = next(reader)
 
@@ -344,6 +1379,11 @@ def csv_select(f, path: str, writer, opts):
 				value_type = types_by_name[type_name.lower()]
 			except KeyError:
 				sys.exit('Type {} not recognized'.format(type_name))
+			if value_type in comparand_types:
+				try:
+					comparand = value_type(comparand)
+				except ValueError:
+					sys.exit('Comparand {} is not a valid {}'.format(repr(comparand), type_name))
 
 			column = SortColumn(column_name, column_idx, value_type=value_type)
 			criterion = Criterion(column, evaluator_class(comparand))
@@ -367,7 +1407,25 @@ def csv_select(f, path: str, writer, opts):
 				else:
 					sys.exit('Conjunction {} not recognized'.format(repr(maybe_and)))
 
-	row_count = select_rows(reader, header, [ conjunction(criteria) ] if conjunction else criteria, writer, opts)
+	criteria = [ conjunction(criteria) ] if conjunction else criteria
+	candidate_offsets = candidate_ranges = None
+	if opts.use_indexes and isinstance(path, pathlib.Path):
+		candidate_offsets = find_indexed_candidates(path, criteria)
+		if candidate_offsets is None:
+			candidate_ranges = find_candidate_blocks(path, criteria)
+
+	if candidate_offsets is not None:
+		with open(path, 'rb') as binary_file:
+			row_count = select_rows(read_records_at(binary_file, candidate_offsets, opts.input_encoding), header, criteria, writer, opts)
+	elif candidate_ranges is not None:
+		with open(path, 'rb') as binary_file:
+			row_count = select_rows(read_records_in_ranges(binary_file, candidate_ranges, opts.input_encoding), header, criteria, writer, opts)
+	elif opts.jobs > 1 and isinstance(path, pathlib.Path):
+		row_count = select_rows_parallel(path, header, criteria, writer, opts)
+	else:
+		# Only the fields the criteria and output need get split out of rows, and only rows that match get parsed in full.
+		lazy_reader = LazyRecordReader(f, fields_needed(criteria, select_columns(header, opts)[0]))
+		row_count = select_rows(lazy_reader, header, criteria, writer, opts, output=output)
 	print('{}\t{:n}'.format(path, row_count), file=sys.stderr)
 
 def parse_pair(pair_str):
@@ -383,7 +1441,16 @@ def main():
 	parser.add_argument('--only-columns', default=None, help="Comma-separated list of columns to include in the output. Defaults to all columns.")
 	parser.add_argument('-l', '--rename-column', '--label-column', type=parse_pair, action='append', dest='column_name_pairs', help='Value is a comma-separated pair of column names. Each former name of a column from the input is changed to the latter in the output.')
 	parser.add_argument('--distinct', action='store_true', default=False, help="Only print unique combinations—if all of a row's values are encountered again on one or more subsequent rows, don't print those rows, only the first one.")
+	parser.add_argument('--memory-budget', type=parse_byte_count, default='1G', help="Approximate amount of memory --distinct can use to remember rows it has seen, in bytes, optionally followed by K, M, G, or T. Beyond that, rows are sorted out using temporary files. Defaults to 1G.")
 	parser.add_argument('--limit', '--max-count', type=int, default=None, help="Stop reading after this many matching rows. Defaults to showing all matches.")
+	parser.add_argument('--date-cache-size', type=int, default=65536, help="For each YEAR/MONTH/DAY comparison, remember whether this many of the most recently used distinct values matched, rather than parsing them again. Defaults to 65536; 0 disables the cache.")
+	parser.add_argument('--sample-rows', type=int, default=1000, help="Evaluate every term for this many rows, measuring how often each term passes and how long it takes, then reorder the terms so that the ones that rule out (or, with OR, rule in) rows most cheaply come first. Defaults to 1000; 0 keeps the terms in the order given. A term that fails to parse a value in the sampled rows keeps its place behind the terms before it; one that only fails on a later row may be reached sooner (raising an error the original order would have avoided) or later.")
+	parser.add_argument('-v', '--verbose', action='store_true', default=False, help="Report statistics, such as date cache hits and misses and the order chosen for the terms, on stderr.")
+	parser.add_argument('-j', '--jobs', type=int, default=1, help="Evaluate the criteria in this many worker processes, each handling a different part of the file. Output is in the same order as with one job. Has no effect when reading from stdin.")
+	parser.add_argument('--build-index', type=parse_index_spec, action='append', dest='index_specs', metavar='COLUMN[:TYPE]', help="Build an index of this column, sorted by its values interpreted as TYPE (str, int, float, or date; default str), in a file next to the input file, then exit. Can be used multiple times to index multiple columns. Later selections with =, <, >, ≤, ≥, or WITHIN on an indexed column of the same type will read only the rows the index says could match, as long as the file hasn't changed.")
+	parser.add_argument('--build-stats', action='append', dest='stats_columns', metavar='COLUMN', help="Divide the input file into blocks and record the minimum and maximum values and the number of empty values of this column in each block, in a file next to the input file, then exit. Can be used multiple times to cover multiple columns; each use of --build-stats replaces all previous statistics. Later selections with =, <, >, ≤, ≥, or WITHIN on one of those columns will skip blocks that can't contain a match, as long as the file hasn't changed. Works best on columns whose values are mostly in order, such as timestamps.")
+	parser.add_argument('--stats-block-size', type=parse_byte_count, default='1M', help="Size of the blocks --build-stats divides the file into, in bytes, optionally followed by K, M, G, or T. Defaults to 1M.")
+	parser.add_argument('--no-index', dest='use_indexes', action='store_false', default=True, help="Don't use any indexes or statistics built with --build-index or --build-stats; read the whole file.")
 	parser.add_argument('input_path', type=pathlib.Path, help="Path to a file containing CSV data to select from.")
 	parser.add_argument('terms', nargs='*', help="Algebraic expressions defining the criteria. A single expression consists of COLUMN OPERATOR COMPARAND. COLUMN must be the name of one of the columns in the file; OPERATOR must be =, ≠, <, >, ≤, or ≥; COMPARAND is a single fixed value to compare to. An additional word in parentheses between the OPERATOR and COMPARAND indicates the type to interpret all values for that column (including the comparand) as; for example, “total_sold ≤ (int) 4000”. Supported types include str (default), int, and float. Compound expressions can be formed using AND. OR and NOT are not supported at this time.")
 	opts = parser.parse_args()
@@ -394,14 +1461,24 @@ def main():
 			column_renames[old_name] = new_name
 	opts.column_renames = column_renames
 
+	path = opts.input_path
+	if opts.index_specs:
+		for column_name, type_name in opts.index_specs:
+			row_count = build_index(path, column_name, type_name, opts.input_encoding)
+			print('Indexed {} as {} for {:n} rows in {}'.format(repr(column_name), type_name, row_count, index_path_for(path, column_name)), file=sys.stderr)
+	if opts.stats_columns:
+		block_count = build_stats(path, opts.stats_columns, opts.stats_block_size, opts.input_encoding)
+		print('Recorded statistics for {:n} blocks in {}'.format(block_count, stats_path_for(path)), file=sys.stderr)
+	if opts.index_specs or opts.stats_columns:
+		return
+
 	writer = csv.writer(sys.stdout)
 
-	path = opts.input_path
 	if path == pathlib.Path('-'):
-		csv_select(sys.stdin, '<stdin>', writer, opts)
+		csv_select(sys.stdin, '<stdin>', writer, opts, output=sys.stdout)
 	else:
 		with open(path, 'r', encoding=opts.input_encoding) as f:
-			csv_select(f, path, writer, opts)
+			csv_select(f, path, writer, opts, output=sys.stdout)
 
 if __name__ == "__main__":
 	main()
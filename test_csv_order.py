@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import pathlib
+import subprocess
+import tempfile
+import unittest
+
+csv_order_path = pathlib.Path(__file__).with_name('csv_order.py')
+
+def run_csv_order(*args):
+	"Run csv_order with the given arguments and return its output."
+	return subprocess.run([ sys.executable, str(csv_order_path) ] + list(args), check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+
+class FloatKeyTests(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.temp_dir.name, 'b.csv')
+		with open(self.path, 'w') as f:
+			f.write('id,x\n')
+			for i in range(2000):
+				f.write('{},{}\n'.format(i, 'nan' if i % 7 == 0 else '' if i % 11 == 0 else (i * 37) % 1000 / 10))
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def test_nan_sorts_the_same_in_memory_on_disk_and_in_parallel(self):
+		for direction in [ 'asc', 'desc' ]:
+			with self.subTest(direction=direction):
+				column = '--column=x:float:' + direction
+				in_memory = run_csv_order(column, self.path)
+				self.assertEqual(run_csv_order(column, '--memory-budget', '2K', self.path), in_memory)
+				self.assertEqual(run_csv_order(column, '--memory-budget', '2K', '--jobs', '2', self.path), in_memory)
+
+				values = [ line.split(',')[1] for line in in_memory.splitlines()[1:] ]
+				nans = [ value == 'nan' for value in values ]
+				# NaNs go after every number: last when ascending, first when descending.
+				self.assertEqual(nans, sorted(nans, reverse=(direction == 'desc')))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import pathlib
+import subprocess
+import tempfile
+import unittest
+
+csv_select_path = pathlib.Path(__file__).with_name('csv_select.py')
+
+def run_csv_select(*args):
+	"Run csv_select with the given arguments and return its output."
+	return subprocess.run([ sys.executable, str(csv_select_path) ] + list(args), check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+
+class IndexTests(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.temp_dir.name, 'b.csv')
+		with open(self.path, 'w') as f:
+			f.write('id,x\n')
+			for i in range(2000):
+				f.write('{},{}\n'.format(i, 'nan' if i % 10 == 0 else (i * 37) % 1000 / 10))
+
+	def tearDown(self):
+		self.temp_dir.cleanup()
+
+	def test_float_index_with_nan_matches_scan(self):
+		run_csv_select('--build-index', 'x:float', self.path)
+		for operator in [ '>', '<', '=', '≥', '≤' ]:
+			for comparand in [ '99', '0.5', '50' ]:
+				terms = [ 'x', operator, '(float)', comparand ]
+				with self.subTest(terms=terms):
+					self.assertEqual(run_csv_select(self.path, *terms), run_csv_select('--no-index', self.path, *terms))
+
+if __name__ == "__main__":
+	unittest.main()